@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""State records for registered speaker actions."""
+
+import collections
+import time
+
+# statuses of an action that no longer plays
+INACTIVE = ('OFF', 'Off/Stop')
+
+
+def format_time(seconds=None):
+    t = time.localtime(seconds)
+    return '%d-%02d-%02d %02d:%02d:%02d' % (t.tm_year,
+                                            t.tm_mon,
+                                            t.tm_mday,
+                                            t.tm_hour,
+                                            t.tm_min,
+                                            t.tm_sec)
+
+
+class ActionState(object):
+    """Last known state of one action.
+
+    Times are kept as epoch floats and only formatted by to_dict(), so
+    registering or releasing an action allocates nothing but the record.
+    """
+
+    __slots__ = ('status', 'timeout', 'changed', 'release_at')
+
+    def __init__(self, status, timeout=0, changed=None, release_at=None):
+        self.status = status
+        self.timeout = timeout
+        self.changed = time.time() if changed is None else changed
+        self.release_at = release_at
+
+    def __repr__(self):
+        return 'ActionState({!r}, {!r}, {!r}, {!r})'.format(self.status,
+                                                            self.timeout,
+                                                            self.changed,
+                                                            self.release_at)
+
+    def to_dict(self):
+        if self.release_at is None:
+            release_at = ''
+        else:
+            release_at = format_time(self.release_at)
+        return {
+            'status': self.status,
+            'timeout': self.timeout,
+            'timestamp': format_time(self.changed),
+            'release_at': release_at
+        }
+
+
+class ActionTable(object):
+    """Action name -> ActionState, bounded in size and age.
+
+    Entries are kept in order of their last change. Ones that have been
+    inactive for ttl seconds are dropped. Above capacity the least
+    recently changed inactive entry is evicted, and a playing one only
+    when no inactive entry is left. version is bumped on every change,
+    for readers caching what they built from it.
+    """
+
+    def __init__(self, capacity=4096, ttl=3600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.table = collections.OrderedDict()
+        # names of the inactive entries, in the same order
+        self.inactive = collections.OrderedDict()
+        self.next_sweep = 0
+        self.version = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, act):
+        return act in self.table
+
+    def __getitem__(self, act):
+        return self.table[act]
+
+    def get(self, act, default=None):
+        return self.table.get(act, default)
+
+    def __setitem__(self, act, state):
+        table = self.table
+        table[act] = state
+        table.move_to_end(act)
+        if state.status in INACTIVE:
+            self.inactive[act] = None
+            self.inactive.move_to_end(act)
+        else:
+            self.inactive.pop(act, None)
+        self.version += 1
+        if state.changed >= self.next_sweep:
+            self.expire(state.changed)
+        while len(table) > self.capacity:
+            if self.inactive:
+                del table[self.inactive.popitem(last=False)[0]]
+            else:
+                table.popitem(last=False)
+            self.evicted += 1
+
+    def items(self):
+        self.expire()
+        return self.table.items()
+
+    def expire(self, now=None):
+        """Drop entries inactive for ttl seconds, return how many."""
+        if now is None:
+            now = time.time()
+        cutoff = now - self.ttl
+        stale = []
+        for act in self.inactive:
+            if self.table[act].changed > cutoff:
+                break
+            stale.append(act)
+        for act in stale:
+            del self.table[act]
+            del self.inactive[act]
+        if stale:
+            self.version += 1
+        self.expired += len(stale)
+        self.next_sweep = now + min(self.ttl, 60)
+        return len(stale)
+
+    def get_info(self):
+        return {
+            'size': len(self.table),
+            'capacity': self.capacity,
+            'ttl': self.ttl,
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
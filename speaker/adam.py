@@ -3,92 +3,149 @@
 
 import asyncio
 import logging
-import struct
+from .codec import (MbapDecoder, mbap_read_coils, mbap_write_coil,
+                    mbap_write_coils)
+from .connection import CommandBuffer, ConnectionManager
 
 
 log = logging.getLogger(__name__)
 
 
-class TcpClientProtocol(asyncio.Protocol):
-
-    def __init__(self, master):
-        self.master = master
-
-    def connection_made(self, transport):
-        self.transport = transport
-        self.master.connected = True
-
-    def data_received(self, data):
-        log.info('Data received: {!r}'.format(data))
-
-    def connection_lost(self, exc):
-        log.error('The server closed the connection')
-        self.master.connected = None
-
-
 class Adam(object):
 
-    HEAD = b'\x00\x00\x00\x00\x00\x06'
-
-    def __init__(self, loop, host, port=502):
+    def __init__(self, loop, host, port=502,
+                 max_pending=16, request_timeout=1.0,
+                 coil_count=8, coalesce_window=0,
+                 poll_interval=10, on_change=None, buffer_size=256,
+                 buffer_timeout=5.0):
         self.station_address = 1
         self.function_code = 5
         self.coil_address = 0x10
-        self.send_str = b''
 
         self.loop = loop or asyncio.get_event_loop()
         self.host = host
         self.port = port
         self.connected = None
-        self.loop.create_task(self._do_connect())
         self.transport = None
         self.coils_state = 0
         self.transaction_id = 0
-        self.protocol_id = 0
-        # self.loop.call_later(6, self.keepAlive)
+        self.decoder = MbapDecoder()
+        # transaction id -> future of the reply pdu
+        self.pending = {}
+        self.window = asyncio.Semaphore(max_pending)
+        self.request_timeout = request_timeout
+        self.coil_count = coil_count
+        # zone changes within the window go out as one FC 0x0F write
+        self.coalesce_window = coalesce_window
+        self.flush_handle = None
+        self.flush_waiters = []
+        self.frames_sent = 0
+        # last coil bank confirmed by the module, None when unknown
+        self.shadow = None
+        self.writes_suppressed = 0
+        self.poll_interval = poll_interval
+        self.on_change = on_change
+        # coil writes held while disconnected, replayed on connect; a
+        # caller stops waiting for them after buffer_timeout
+        self.buffer = CommandBuffer(buffer_size)
+        self.buffer_timeout = buffer_timeout
+        if poll_interval:
+            self.poll_task = self.loop.create_task(self._poll_coils())
+        self.conn = ConnectionManager(self.loop, host, port, self)
+        self.conn.start()
 
-    async def _do_connect(self):
-        while True:
-            await asyncio.sleep(5)
-            if self.connected:
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected = True
+        self.loop.create_task(self._sync_coils())
+
+    async def _sync_coils(self):
+        coils = await self.read_coils_status()
+        log.info('Adam-6017 coils status: {}'.format(coils))
+        if coils is not None:
+            self._update_shadow(coils)
+        waiters = [fut for item in self.buffer.drain() for fut in item]
+        if waiters:
+            log.info('Adam-6017 replay buffered coils '
+                     '{:#x}'.format(self.coils_state))
+            self.flush_waiters.extend(waiters)
+            self._schedule_flush()
+        elif coils is not None:
+            self.coils_state = coils
+
+    def get_info(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'state': self.conn.state,
+            'coils': self.coils_state,
+            'shadow': self.shadow,
+            'frames_sent': self.frames_sent,
+            'writes_suppressed': self.writes_suppressed,
+            'buffer': self.buffer.get_info(),
+        }
+
+    def data_received(self, data):
+        try:
+            frames = self.decoder.feed(data)
+        except ValueError as e:
+            log.error('Adam-6017 stream error: {}'.format(e))
+            return
+        for tid, unit, pdu in frames:
+            if pdu[0] & 0x80:
+                log.error('Adam-6017 Function[0x{:02X}] exception '
+                          'code {}'.format(pdu[0] & 0x7F, pdu[1]))
+            fut = self.pending.pop(tid, None)
+            if fut is None or fut.done():
+                log.warning('Adam-6017 unexpected reply '
+                            '[{}]: {!r}'.format(tid, pdu))
                 continue
+            fut.set_result(pdu)
+
+    def connection_lost(self, exc):
+        self.connected = None
+        self.transport = None
+        self.shadow = None
+        self.decoder.reset()
+        for fut in self.pending.values():
+            if not fut.done():
+                fut.set_result(None)
+        self.pending.clear()
+
+    def _next_tid(self):
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        return self.transaction_id
+
+    async def request(self, cmd):
+        """Send one frame, return the reply pdu or None on failure."""
+        async with self.window:
+            tid = (cmd[0] << 8) | cmd[1]
+            fut = self.loop.create_future()
+            self.pending[tid] = fut
             try:
-                xt, _ = await self.loop.create_connection(
-                    lambda: TcpClientProtocol(self),
-                    self.host,
-                    self.port)
-                log.info('Connection create on {}'.format(xt))
-                self.transport = xt
-                self.connected = True
-                self.read_coils_status()
-                # self.login()
-            except OSError:
-                log.error('Server not up retrying in 5 seconds...')
-            except Exception as e:
-                log.error('Error when connect to server: {}'.format(e))
-
-    def _command_head(self, length):
-        self.transaction_id += 1
-        s = struct.Struct('>HHH')
-        values = (self.transaction_id,
-                  self.protocol_id,
-                  length)
-        return s.pack(*values)
+                if not self.call(cmd):
+                    return None
+                return await asyncio.wait_for(fut, self.request_timeout)
+            except asyncio.TimeoutError:
+                log.error('Adam-6017 no reply for transaction '
+                          '{} in {}s'.format(tid, self.request_timeout))
+                return None
+            finally:
+                if self.pending.get(tid) is fut:
+                    del self.pending[tid]
 
     # function code is 1
-    def read_coils_status(self):
-        self.send_str = self._command_head(6)
-        s = struct.Struct('>BBHH')
-        values = (self.station_address,
-                  1,
-                  self.coil_address,
-                  8)
-        self.send_str += s.pack(*values)
+    async def read_coils_status(self):
+        cmd = mbap_read_coils(self._next_tid(), self.station_address,
+                              self.coil_address, self.coil_count)
         log.info('Adam-6017 read_coil_status...')
-        return self.call(self.send_str)
+        pdu = await self.request(cmd)
+        if not pdu or pdu[0] != 1 or len(pdu) < 2 + pdu[1]:
+            return None
+        return int.from_bytes(pdu[2:2 + pdu[1]], 'little')
 
     # function code is 5
-    def force_single_coil(self, address, action):
+    async def force_single_coil(self, address, action):
         if action.upper() == 'OFF':
             act = 0x0000
         elif action.upper() == 'ON':
@@ -96,41 +153,39 @@ class Adam(object):
         else:
             act = 0xFFFF
 
-        self.send_str = self._command_head(6)
-        s = struct.Struct('>BBHH')
-        values = (self.station_address,
-                  5,
-                  address,
-                  act)
-        self.send_str += s.pack(*values)
-        log.info('Adam-6017 Function[0x05]({})'.format(action, address))
-        return self.call(self.send_str)
+        cmd = mbap_write_coil(self._next_tid(), self.station_address,
+                              address, act)
+        log.info('Adam-6017 Function[0x05]({}, {})'.format(action, address))
+        pdu = await self.request(cmd)
+        return pdu == cmd[7:]
 
     # function code is f
-    def force_multi_coils(self, data):
-        self.send_str = self._command_head(8)
-        s = struct.Struct('>BBHHBB')
-        values = (self.station_address,
-                  0x0f,
-                  self.coil_address,
-                  0x08,
-                  0x01,
-                  data)
-        self.send_str += s.pack(*values)
-        log.info('Adam-6017 Function[0x0F]({})'.format(data))
-        return self.call(self.send_str)
+    async def force_multi_coils(self, data, count=None):
+        count = count or self.coil_count
+        cmd = mbap_write_coils(self._next_tid(), self.station_address,
+                               self.coil_address, count, data)
+        log.info('Adam-6017 Function[0x0F]({:#x}, {})'.format(data, count))
+        pdu = await self.request(cmd)
+        return pdu == cmd[7:12]
 
     def call(self, cmd):
-        log.info('Try to send: {}'.format(cmd))
+        log.info('Try to send: {}'.format(bytes(cmd)))
         if self.transport:
             self.transport.write(cmd)
-            log.debug('send cmd to server: {}'.format(cmd))
+            self.frames_sent += 1
+            log.debug('send cmd to server: {}'.format(bytes(cmd)))
+            return True
         else:
             log.error('Invalid server transport.')
+            return False
 
     # zone = 0: do-0
     # zone = 1: do-1
-    def alarm_task(self, action, task, zone=0):
+    async def alarm_task(self, action, task, zone=0):
+        if not 0 <= zone < self.coil_count:
+            log.warning('Adam-6017 zone {} out of range '
+                        '0..{}'.format(zone, self.coil_count - 1))
+            return False
         if action.upper() == 'OFF':
             self.coils_state &= ~(1 << zone)
         elif action.upper() == 'ON':
@@ -138,10 +193,78 @@ class Adam(object):
         else:
             self.coils_state = 0
 
-        self.force_single_coil(self.coil_address + zone,
-                               action)
-        # self.read_coils_status()
-        # self.force_multi_coils(self.coils_state)
+        fut = self.loop.create_future()
+        self.flush_waiters.append(fut)
+        self._schedule_flush()
+        try:
+            return await asyncio.wait_for(fut, self.buffer_timeout)
+        except asyncio.TimeoutError:
+            # the bank write stays buffered with the latest coils
+            log.error('Adam-6017 coils not written in {}s'.format(
+                self.buffer_timeout))
+            return False
+
+    def _schedule_flush(self):
+        if self.flush_handle is not None:
+            return
+        if self.coalesce_window > 0:
+            self.flush_handle = self.loop.call_later(self.coalesce_window,
+                                                     self._flush_coils)
+        else:
+            self.flush_handle = self.loop.call_soon(self._flush_coils)
+
+    def _flush_coils(self):
+        self.flush_handle = None
+        waiters, self.flush_waiters = self.flush_waiters, []
+        if self.coils_state == self.shadow:
+            self.writes_suppressed += 1
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_result(True)
+            return
+        if not self.transport:
+            # collapsed writes share the replayed bank write
+            old = self.buffer.put('coils', waiters)
+            if old:
+                waiters[:0] = old
+            log.warning('Adam-6017 not connected, buffered coils '
+                        '{:#x}'.format(self.coils_state))
+            return
+        self.loop.create_task(self._write_coils(self.coils_state, waiters))
+
+    async def _write_coils(self, state, waiters):
+        ack = await self.force_multi_coils(state)
+        if ack:
+            self._update_shadow(state)
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(ack)
+
+    def _update_shadow(self, coils):
+        old, self.shadow = self.shadow, coils
+        if old is None or old == coils or self.on_change is None:
+            return
+        diff = old ^ coils
+        changes = [(zone, bool(coils >> zone & 1))
+                   for zone in range(self.coil_count) if diff >> zone & 1]
+        try:
+            self.on_change(changes)
+        except Exception as e:
+            log.error('Adam-6017 on_change exception: {}'.format(e))
+
+    async def _poll_coils(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not self.connected:
+                continue
+            coils = await self.read_coils_status()
+            if coils is None:
+                continue
+            self._update_shadow(coils)
+            if coils != self.coils_state and self.flush_handle is None:
+                log.warning('Adam-6017 coils {:#x} differ from wanted {:#x}, '
+                            'rewriting'.format(coils, self.coils_state))
+                self._schedule_flush()
 
 
 if __name__ == '__main__':
@@ -162,13 +285,16 @@ if __name__ == '__main__':
     host = '127.0.0.1'
     adam = Adam(loop, host, port)
 
-    asyncio.sleep(10)
-    adam.alarm_task('ON', 1)
-    adam.alarm_task('OFF', 1)
-    adam.alarm_task('release', 1)
-    adam.alarm_task('ON', 1, 1)
-    adam.alarm_task('OFF', 1, 1)
-    adam.alarm_task('release', 1, 1)
+    async def main():
+        await adam.conn.wait_connected()
+        await adam.alarm_task('ON', 1)
+        await adam.alarm_task('OFF', 1)
+        await adam.alarm_task('release', 1)
+        await adam.alarm_task('ON', 1, 1)
+        await adam.alarm_task('OFF', 1, 1)
+        await adam.alarm_task('release', 1, 1)
+
+    loop.create_task(main())
 
     # Serve requests until Ctrl+C is pressed
     try:
@@ -5,18 +5,56 @@
 
 import logging
 import asyncio
+import gzip
+import hashlib
 import json
+import time
+from email.utils import formatdate
 from aiohttp import web
 
 log = logging.getLogger(__name__)
 
 
+class Snapshot(object):
+    """A serialized response body with its cache validators."""
+
+    def __init__(self, body, modified=None, previous=None):
+        self.body = body
+        digest = hashlib.md5(body).hexdigest()
+        # each encoding is its own representation
+        self.etag = '"{}"'.format(digest)
+        self.gzip_etag = '"{}-gzip"'.format(digest)
+        self.modified = int(time.time() if modified is None else modified)
+        self.last_modified = formatdate(self.modified, usegmt=True)
+        # a body replaced within the second of the one before shares its
+        # Last-Modified, so only the ETag can tell them apart
+        self.exact = previous is None or previous.modified < self.modified
+        self.gzipped = None
+
+    def gzip(self):
+        if self.gzipped is None:
+            self.gzipped = gzip.compress(self.body)
+        return self.gzipped
+
+    def matches(self, request):
+        """True if the client copy is current, for a 304."""
+        etags = request.headers.get('If-None-Match')
+        if etags is not None:
+            tags = [tag.strip() for tag in etags.split(',')]
+            return ('*' in tags or self.etag in tags or
+                    self.gzip_etag in tags)
+        since = request.if_modified_since
+        return (self.exact and since is not None and
+                since.timestamp() >= self.modified)
+
+
 class Api(object):
     ''' Application Interface for RPS
     '''
 
-    def __init__(self, loop, port=8080, site=None, amqp=None):
+    def __init__(self, loop, port=8080, site=None, amqp=None, refresh=5.0):
         loop = loop or asyncio.get_event_loop()
+        self.loop = loop
         self.app = web.Application(loop=loop)
         self.app.router.add_get('/', self.index)
         self.app.router.add_get('/v2/system', self.handle_system)
@@ -24,6 +62,14 @@ class Api(object):
         self.port = port
         self.amqp = amqp
         self.db = {}
+        # /v2/system body, rebuilt when the actions change or, for the
+        # live counters, once it is refresh seconds old
+        self.refresh = refresh
+        self.snapshot = None
+        self.snapshot_version = None
+        self.snapshot_time = 0
+        self.builds = 0
+        self.not_modified = 0
 
     def start(self):
         # outside
@@ -35,6 +81,8 @@ class Api(object):
             'amqp': self.amqp.get_info(),
             'api_version': 'V1',
             'api': ['v2/system'],
+            'snapshot': {'builds': self.builds,
+                         'not_modified': self.not_modified},
             'modules version': 'IPP-I'}))
 
     def get_system(self):
@@ -42,7 +90,35 @@ class Api(object):
             'system': self.site.get_info(),
         }
 
+    def get_snapshot(self):
+        now = self.loop.time()
+        if (self.snapshot is None or
+                self.site.actions.version != self.snapshot_version or
+                now - self.snapshot_time >= self.refresh):
+            body = json.dumps(self.get_system()).encode('utf-8')
+            self.builds += 1
+            if self.snapshot is None or body != self.snapshot.body:
+                self.snapshot = Snapshot(body, previous=self.snapshot)
+            # read after building, which may expire old actions
+            self.snapshot_version = self.site.actions.version
+            self.snapshot_time = now
+        return self.snapshot
+
     async def handle_system(self, request):
-        data = self.get_system()
-        return web.Response(
-            text=json.dumps(data))
+        snapshot = self.get_snapshot()
+        packed = 'gzip' in request.headers.get('Accept-Encoding', '')
+        headers = {
+            'ETag': snapshot.gzip_etag if packed else snapshot.etag,
+            'Last-Modified': snapshot.last_modified,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+        if snapshot.matches(request):
+            self.not_modified += 1
+            return web.Response(status=304, headers=headers)
+        if packed:
+            headers['Content-Encoding'] = 'gzip'
+            return web.Response(body=snapshot.gzip(), headers=headers,
+                                content_type='application/json')
+        return web.Response(body=snapshot.body, headers=headers,
+                            content_type='application/json')
@@ -3,81 +3,222 @@
 
 import asyncio
 import logging
+from .codec import (OIP_CALL_REPLY, OipDecoder, oip_keep_alive, oip_login,
+                    oip_start_call, oip_stop_call)
+from .connection import CommandBuffer, ConnectionManager
 
 log = logging.getLogger(__name__)
 
 
-class TcpClientProtocol(asyncio.Protocol):
-
-    def __init__(self, master):
-        self.master = master
-
-    def connection_made(self, transport):
-        self.transport = transport
-        self.master.connected = True
-
-    def data_received(self, data):
-        log.debug('Data received: {!r}'.format(data.decode()))
-
-    def connection_lost(self, exc):
-        log.error('The server closed the connection')
-        self.master.connected = None
-
-
 class Bosch(object):
-    TYPE_OIP_Login = b'\x02\x70\x44\x00\x22\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x05\x00\x00\x00\x61\x64\x6d\x69\x6e\x05\x00\x00\x00\x61\x64\x6d\x69\x6e'
-    TYPE_OIP_StartCall = b'\x03\x70\x44\x00\x39\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x50\x00\x00\x00\x00\x00\x00\x00\x00\x00\x03\x00\x00\x00\x41\x4c\x4c\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x08\x00\x00\x00\x78\x69\x61\x6f\x66\x61\x6e\x67'
-    TYPE_OIP_KeepAlive = b'\x27\x70\x44\x00\x10\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 
     def __init__(self, loop, host, port,
-                 user='admin', passwd='admin'):
+                 user='admin', passwd='admin',
+                 priority=80, message='', timeout=2.0,
+                 keepalive_idle=5, keepalive_misses=3, buffer_size=256,
+                 buffer_timeout=5.0):
         self.loop = loop
         self.host = host
         self.port = port
         self.user = user
         self.passwd = passwd
+        self.priority = priority
+        self.message = message
+        self.timeout = timeout
         self.connected = None
-        self.loop.create_task(self._do_connect())
         self.transport = None
-        self.loop.call_later(6, self.keepAlive)
+        self.decoder = OipDecoder()
+        self.reference = 0
+        # reference -> future of the (type, body) reply
+        self.pending = {}
+        # keepalives go out only after keepalive_idle seconds without
+        # other traffic; keepalive_misses unanswered keepalives or
+        # requests in a row drop the session
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_misses = keepalive_misses
+        self.keepalive_handle = None
+        self.missed = 0
+        self.last_sent = 0
+        # (build, args, future) of commands held while disconnected; a
+        # request gives up on its buffered frame after buffer_timeout
+        self.buffer = CommandBuffer(buffer_size)
+        self.buffer_timeout = buffer_timeout
+        self.conn = ConnectionManager(self.loop, host, port, self)
+        self.conn.start()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected = True
+        self.missed = 0
+        self.login()
+        self._arm_keepalive(self.last_sent + self.keepalive_idle)
+        items = self.buffer.drain()
+        if items:
+            log.info('Replay {} buffered commands'.format(len(items)))
+        for build, args, fut in items:
+            if fut is not None and fut.done():
+                # the request gave up waiting
+                continue
+            if fut is None:
+                self.call(build(*args))
+            else:
+                self.loop.create_task(self._replay(build, args, fut))
 
-    async def _do_connect(self):
-        while True:
-            await asyncio.sleep(5)
-            if self.connected:
+    async def _replay(self, build, args, fut):
+        reply = await self.request(build, *args)
+        if not fut.done():
+            fut.set_result(reply)
+
+    def _buffer(self, key, build, args, fut=None):
+        log.warning('Server not connected, buffered {}{}'.format(
+            build.__name__, args))
+        old = self.buffer.put(key, (build, args, fut))
+        if old is not None and old[2] is not None and not old[2].done():
+            old[2].set_result(None)
+
+    def get_info(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'state': self.conn.state,
+            'calls_pending': len(self.pending),
+            'buffer': self.buffer.get_info(),
+        }
+
+    def data_received(self, data):
+        self.missed = 0
+        try:
+            frames = self.decoder.feed(data)
+        except ValueError as e:
+            log.error('OIP stream error: {}'.format(e))
+            return
+        for msg_type, reference, body in frames:
+            fut = self.pending.pop(reference, None)
+            if fut is None or fut.done():
+                log.debug('OIP message [{:#x}] ref {}: {!r}'.format(
+                    msg_type, reference, body))
                 continue
+            fut.set_result((msg_type, body))
+
+    def connection_lost(self, exc):
+        self.connected = None
+        self.transport = None
+        if self.keepalive_handle is not None:
+            self.keepalive_handle.cancel()
+            self.keepalive_handle = None
+        self.decoder.reset()
+        for fut in self.pending.values():
+            if not fut.done():
+                fut.set_result(None)
+        self.pending.clear()
+
+    def _next_reference(self):
+        self.reference = self.reference % 0xFFFFFFFF + 1
+        return self.reference
+
+    async def request(self, build, *args, key=None):
+        """Send the frame from build(*args, reference), await the reply."""
+        if not self.transport:
+            fut = self.loop.create_future()
+            self._buffer(key, build, args, fut)
             try:
-                xt, _ = await self.loop.create_connection(
-                    lambda: TcpClientProtocol(self),
-                    self.host,
-                    self.port)
-                log.info('Connection create on {}'.format(xt))
-                self.transport = xt
-                self.login()
-            except OSError:
-                log.error('Server not up retrying in 5 seconds...')
-            except Exception as e:
-                log.error('Error when connect to server: {}'.format(e))
+                return await asyncio.wait_for(fut, self.buffer_timeout)
+            except asyncio.TimeoutError:
+                # not replayed later, its reply would have nowhere to go
+                item = self.buffer.items.get(key)
+                if key is not None and item is not None and item[2] is fut:
+                    self.buffer.discard(key)
+                log.error('Server not connected in {}s, dropped {}{}'.format(
+                    self.buffer_timeout, build.__name__, args))
+                return None
+        reference = self._next_reference()
+        fut = self.loop.create_future()
+        self.pending[reference] = fut
+        try:
+            if not self.call(build(*args, reference=reference)):
+                return None
+            return await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            log.error('No OIP reply for ref {} in {}s'.format(
+                reference, self.timeout))
+            self.missed += 1
+            self._check_missed()
+            return None
+        finally:
+            if self.pending.get(reference) is fut:
+                del self.pending[reference]
 
     def call(self, cmd):
         if self.transport:
             self.transport.write(cmd)
-            log.debug('send cmd to server: {}'.format(cmd))
+            self.last_sent = self.loop.time()
+            log.debug('send cmd to server: {}'.format(bytes(cmd)))
+            return True
         else:
             log.error('Invalid server transport.')
+            return False
 
     def login(self):
         log.info('send cmd to server: [login]')
-        self.call(self.TYPE_OIP_Login)
+        self.call(oip_login(self.user, self.passwd))
+
+    def _arm_keepalive(self, when):
+        self.keepalive_handle = self.loop.call_at(when, self.keepAlive)
 
     def keepAlive(self):
-        log.info('send cmd to server: [keepAlive]')
-        self.call(self.TYPE_OIP_KeepAlive)
-        self.loop.call_later(5, self.keepAlive)
+        self.keepalive_handle = None
+        if not self.transport:
+            return
+        if self._check_missed():
+            return
+        now = self.loop.time()
+        idle_until = self.last_sent + self.keepalive_idle
+        if now >= idle_until:
+            log.debug('send cmd to server: [keepAlive]')
+            self.missed += 1
+            self.call(oip_keep_alive())
+            idle_until = now + self.keepalive_idle
+        self._arm_keepalive(idle_until)
+
+    def _check_missed(self):
+        """Drop the session after too many unanswered frames."""
+        if self.missed < self.keepalive_misses or not self.transport:
+            return False
+        log.error('No reply to {} frames, '
+                  'dropping the connection'.format(self.missed))
+        self.transport.abort()
+        return True
+
+    async def startCall(self, zones):
+        """Start a call on zones, return its call id or None."""
+        log.info('send cmd to server: [startCall] {}'.format(zones))
+        reply = await self.request(oip_start_call, zones,
+                                   self.priority, self.message,
+                                   key=('call', tuple(zones)))
+        if reply is None or len(reply[1]) < OIP_CALL_REPLY.size:
+            return None
+        error, call_id = OIP_CALL_REPLY.unpack_from(reply[1])
+        if error:
+            log.error('startCall {} failed: error {}'.format(zones, error))
+            return None
+        return call_id
+
+    def stopCall(self, call_id, zones=None):
+        log.info('send cmd to server: [stopCall] {}'.format(call_id))
+        if not self.transport:
+            key = ('call', tuple(zones)) if zones else None
+            self._buffer(key, oip_stop_call, (call_id,))
+            return False
+        return self.call(oip_stop_call(call_id))
 
-    def startCall(self):
-        log.info('send cmd to server: [startCall]')
-        self.call(self.TYPE_OIP_StartCall)
+    def cancelCall(self, zones):
+        """Drop a startCall still buffered for zones."""
+        item = self.buffer.discard(('call', tuple(zones)))
+        if item is None:
+            return False
+        if item[2] is not None and not item[2].done():
+            item[2].set_result(None)
+        return True
 
 
 class EchoServerClientProtocol(asyncio.Protocol):
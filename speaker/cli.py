@@ -5,6 +5,8 @@
 import click
 from .log import get_log
 from .routermq import RouterMQ
+from .actions import ActionTable
+from .registry import DeviceRegistry
 from .speaker_spon import Speaker_Spon
 from .speaker_bosch import Speaker_Bosch
 from .speaker_adam import Speaker_Adam
@@ -28,7 +30,8 @@ def validate_url(ctx, param, value):
               callback=validate_url,
               envvar='SPK_SVR',
               help='Speaker Server URL, \n \
-              ENV: SPK_SVR, default: tcp://localhost:2048')
+              ENV: SPK_SVR, default: tcp://localhost:2048, \
+              spon cluster: url?terminals=1-200;url?terminals=201-400')
 @click.option('--release_time', default=20,
               envvar='RELEASE_TIME',
               help='Release time for action, default=20, ENV: RELEASE_TIME')
@@ -42,6 +45,22 @@ def validate_url(ctx, param, value):
 @click.option('--qid', default=0,
               envvar='SVC_QID',
               help='ID for amqp queue name, default=0, ENV: SVC_QID')
+@click.option('--prefetch', default=32,
+              envvar='SVC_PREFETCH',
+              help='Amqp messages handled at once, default=32, \
+              ENV: SVC_PREFETCH')
+@click.option('--devices', default=None,
+              envvar='SVC_DEVICES',
+              help='JSON file of named devices and groups, \
+              ENV: SVC_DEVICES')
+@click.option('--max_actions', default=4096,
+              envvar='SVC_MAX_ACTIONS',
+              help='Actions kept for the api, default=4096, \
+              ENV: SVC_MAX_ACTIONS')
+@click.option('--action_ttl', default=3600,
+              envvar='SVC_ACTION_TTL',
+              help='Seconds a stopped action is kept, default=3600, \
+              ENV: SVC_ACTION_TTL')
 @click.option('--debug', is_flag=True)
 @click.option('--user', default='admin',
               envvar='SVR_USER',
@@ -51,8 +70,8 @@ def validate_url(ctx, param, value):
               envvar='SVR_PASSWD',
               help='User passwd for speaker server, \
               ENV: SVR_PASSWD')
-def main(svr_type, spk_svr, release_time, amqp, port, qid, debug,
-         user, passwd):
+def main(svr_type, spk_svr, release_time, amqp, port, qid, prefetch,
+         devices, max_actions, action_ttl, debug, user, passwd):
     """Publisher for PM-1 with IPP protocol"""
 
     click.echo("See more documentation at http://www.mingvale.com")
@@ -63,6 +82,10 @@ def main(svr_type, spk_svr, release_time, amqp, port, qid, debug,
         'release time': release_time,
         'api_port': port,
         'amqp': amqp,
+        'prefetch': prefetch,
+        'devices': devices,
+        'max actions': max_actions,
+        'action ttl': action_ttl,
     }
     log = get_log(debug)
     log.info('Basic Information: {}'.format(info))
@@ -73,24 +96,39 @@ def main(svr_type, spk_svr, release_time, amqp, port, qid, debug,
     # main process
     try:
         _svr_type = svr_type.upper()
+        if devices:
+            registry = DeviceRegistry.load(devices, driver=svr_type)
+        else:
+            registry = DeviceRegistry()
+        actions = ActionTable(max_actions, action_ttl)
         if _svr_type == 'SPON':
             log.info('Server type: Spon')
-            site = Speaker_Spon(loop, spk_svr, release_time)
+            site = Speaker_Spon(loop, spk_svr, release_time,
+                                registry=registry, actions=actions)
         elif _svr_type == 'BOSCH':
             log.info('Server type: Bosch')
             site = Speaker_Bosch(loop, spk_svr, release_time,
-                                 user, passwd)
+                                 user, passwd, registry=registry,
+                                 actions=actions)
         elif _svr_type == 'ADAM':
             log.info('Server type: Adam-6017')
-            site = Speaker_Adam(loop, spk_svr, release_time)
+            site = Speaker_Adam(loop, spk_svr, release_time,
+                                registry=registry, actions=actions)
         else:
             log.warn('Undefined server type, use default.')
-            site = Speaker_Spon(loop, spk_svr, release_time)
+            site = Speaker_Spon(loop, spk_svr, release_time,
+                                registry=registry, actions=actions)
         router = RouterMQ(outgoing_key='Alarms.speaker',
                           routing_keys=['Actions.speaker'],
                           queue_name='speaker_'+str(qid),
-                          url=amqp)
+                          url=amqp,
+                          loop=loop,
+                          prefetch=prefetch,
+                          max_in_flight=prefetch,
+                          decode=registry.decode)
         router.set_callback(site.got_command)
+        router.set_flow(site.scheduler)
+        router.set_superseded(site.superseded)
         site.set_publish(router.publish)
         api = Api(loop=loop, port=port, site=site, amqp=router)
         site.start()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""Frame encoders and decoders of the speaker server protocols.
+
+Encoders pack a whole frame into the caller's buf at offset and return
+a memoryview of it, or return bytes when buf is None. A buffer must
+not be reused while a request may still resend the frame in it.
+"""
+
+import struct
+
+# Spon UDP: head, opcode, then action and two terminal/task words
+SPON_HEAD = b'\xFF\xFF'
+SPON_TERMINAL_CONTROL = SPON_HEAD + b'\xC1'
+SPON_BROADCAST = SPON_HEAD + b'\xC3'
+SPON_ALARM_TASK = SPON_HEAD + b'\xCA'
+SPON_PARAMS = struct.Struct('<BHH')
+SPON_FRAME = struct.Struct('<3sBHH')
+SPON_SIZE = SPON_FRAME.size
+# bitmap bytes of the 128 and 1000 terminal broadcasts
+SPON_CONTROL_BYTES = 16
+SPON_EXTEND_BYTES = 125
+
+# Modbus TCP: MBAP header (transaction, protocol, length, unit) + pdu
+MBAP_HEADER = struct.Struct('>HHHB')
+MBAP_MAX_LENGTH = 254
+MODBUS_READ_COILS = 0x01
+MODBUS_WRITE_COIL = 0x05
+MODBUS_WRITE_COILS = 0x0F
+# whole frames: header, function, address, count or value
+MBAP_REQUEST = struct.Struct('>HHHBBHH')
+MBAP_WRITE_COILS = struct.Struct('>HHHBBHHB')
+
+# Praesideo OIP message types
+OIP_LOGIN = 0x00447002
+OIP_START_CALL = 0x00447003
+OIP_STOP_CALL = 0x00447004
+OIP_KEEP_ALIVE = 0x00447027
+
+# type, total length, reserved, reference
+OIP_HEADER = struct.Struct('<IIII')
+OIP_UINT = struct.Struct('<I')
+# priority, call options (all off)
+OIP_START_CALL_HEAD = struct.Struct('<I6x')
+# error code, call id
+OIP_CALL_REPLY = struct.Struct('<II')
+# one frame is sent with an empty body
+OIP_KEEP_ALIVE_FRAME = OIP_HEADER.pack(OIP_KEEP_ALIVE, OIP_HEADER.size, 0, 0)
+
+
+def _frame(buf, offset, size):
+    if buf is None:
+        return bytearray(size), 0
+    if len(buf) < offset + size:
+        raise ValueError('Buffer too small for a {} byte frame'.format(size))
+    return buf, offset
+
+
+def _copy(buf, offset, parts):
+    """Write parts into buf at offset, return a view of them."""
+    size = sum(len(part) for part in parts)
+    if len(buf) < offset + size:
+        raise ValueError('Buffer too small for a {} byte frame'.format(size))
+    end = offset
+    for part in parts:
+        buf[end:end + len(part)] = part
+        end += len(part)
+    return memoryview(buf)[offset:end]
+
+
+# Spon
+
+def spon_encode(head, act, src, dest, buf=None, offset=0):
+    if buf is None:
+        return SPON_FRAME.pack(head, act, src, dest)
+    SPON_FRAME.pack_into(buf, offset, head, act, src, dest)
+    return memoryview(buf)[offset:offset + SPON_SIZE]
+
+
+def spon_encode_bitmap(act, src, terminals, nbytes, buf=None, offset=0):
+    """0xC3 broadcast of a TerminalSet, nbytes of bitmap."""
+    buf, offset = _frame(buf, offset, SPON_SIZE + nbytes)
+    SPON_FRAME.pack_into(buf, offset, SPON_BROADCAST, act, src, 0x00)
+    end = terminals.pack_into(buf, offset + SPON_SIZE, nbytes)
+    return memoryview(buf)[offset:end]
+
+
+def spon_decode(data):
+    """Return (opcode, action, src, dest) of a Spon frame."""
+    if len(data) < SPON_SIZE or data[:2] != SPON_HEAD:
+        raise ValueError('Invalid Spon frame: {}'.format(bytes(data)))
+    return (data[2],) + SPON_PARAMS.unpack_from(data, 3)
+
+
+def spon_reply_key(data):
+    # replies echo the opcode, the action and the terminal/task words;
+    # every 0xC3 extend frame has the same words, only the action differs
+    return data[2], data[3], bytes(data[4:8])
+
+
+# Modbus TCP
+
+def mbap_read_coils(tid, unit, address, count, buf=None, offset=0):
+    if buf is None:
+        return MBAP_REQUEST.pack(tid, 0, 6, unit, MODBUS_READ_COILS,
+                                 address, count)
+    MBAP_REQUEST.pack_into(buf, offset, tid, 0, 6, unit,
+                           MODBUS_READ_COILS, address, count)
+    return memoryview(buf)[offset:offset + MBAP_REQUEST.size]
+
+
+def mbap_write_coil(tid, unit, address, value, buf=None, offset=0):
+    if buf is None:
+        return MBAP_REQUEST.pack(tid, 0, 6, unit, MODBUS_WRITE_COIL,
+                                 address, value)
+    MBAP_REQUEST.pack_into(buf, offset, tid, 0, 6, unit,
+                           MODBUS_WRITE_COIL, address, value)
+    return memoryview(buf)[offset:offset + MBAP_REQUEST.size]
+
+
+def mbap_write_coils(tid, unit, address, count, data, buf=None, offset=0):
+    """FC 0x0F of count coils, coil n is bit n of the int data."""
+    size = (count + 7) // 8
+    length = MBAP_WRITE_COILS.size + size
+    buf, offset = _frame(buf, offset, length)
+    MBAP_WRITE_COILS.pack_into(buf, offset, tid, 0, length - 6, unit,
+                               MODBUS_WRITE_COILS, address, count, size)
+    buf[offset + MBAP_WRITE_COILS.size:offset + length] = data.to_bytes(
+        size, 'little')
+    return memoryview(buf)[offset:offset + length]
+
+
+class MbapDecoder(object):
+    """Split a Modbus TCP byte stream into (transaction, unit, pdu)."""
+
+    HEADER = MBAP_HEADER
+    MAX_LENGTH = MBAP_MAX_LENGTH
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def reset(self):
+        del self.buffer[:]
+
+    def feed(self, data):
+        buf = self.buffer
+        buf.extend(data)
+        frames = []
+        while len(buf) >= self.HEADER.size:
+            tid, pid, length, unit = self.HEADER.unpack_from(buf)
+            if pid != 0 or length < 2 or length > self.MAX_LENGTH:
+                self.reset()
+                raise ValueError('Invalid MBAP header: pid={}, '
+                                 'length={}'.format(pid, length))
+            end = 6 + length
+            if len(buf) < end:
+                break
+            frames.append((tid, unit, bytes(buf[self.HEADER.size:end])))
+            del buf[:end]
+        return frames
+
+
+# Praesideo OIP
+
+def oip_string(value):
+    data = value.encode('utf-8')
+    return OIP_UINT.pack(len(data)) + data
+
+
+def _oip_emit(msg_type, parts, reference, buf, offset):
+    # parts is the body, the header goes in front of it
+    size = OIP_HEADER.size + sum(len(part) for part in parts)
+    header = OIP_HEADER.pack(msg_type, size, 0, reference)
+    if buf is None:
+        return b''.join([header] + parts)
+    return _copy(buf, offset, [header] + parts)
+
+
+def oip_frame(msg_type, body=b'', reference=0, buf=None, offset=0):
+    return _oip_emit(msg_type, [body], reference, buf, offset)
+
+
+def oip_login(user, passwd, reference=0, buf=None, offset=0):
+    return _oip_emit(OIP_LOGIN, [oip_string(user), oip_string(passwd)],
+                     reference, buf, offset)
+
+
+def oip_keep_alive(reference=0, buf=None, offset=0):
+    if reference == 0 and buf is None:
+        return OIP_KEEP_ALIVE_FRAME
+    return _oip_emit(OIP_KEEP_ALIVE, [], reference, buf, offset)
+
+
+# start chime, end chime and audio input are left empty
+OIP_START_CALL_INPUTS = oip_string('') * 3
+
+
+def oip_start_call(zones, priority=80, message='', reference=0,
+                   buf=None, offset=0):
+    """StartCall on the given zone names with one prerecorded message."""
+    return _oip_emit(OIP_START_CALL,
+                     [OIP_START_CALL_HEAD.pack(priority),
+                      oip_string(','.join(zones)),
+                      OIP_START_CALL_INPUTS,
+                      oip_string(message)],
+                     reference, buf, offset)
+
+
+def oip_stop_call(call_id, reference=0, buf=None, offset=0):
+    return _oip_emit(OIP_STOP_CALL, [OIP_UINT.pack(call_id)],
+                     reference, buf, offset)
+
+
+class OipDecoder(object):
+    """Split an OIP byte stream into (type, reference, body)."""
+
+    MAX_LENGTH = 0x10000
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def reset(self):
+        del self.buffer[:]
+
+    def feed(self, data):
+        buf = self.buffer
+        buf.extend(data)
+        frames = []
+        while len(buf) >= OIP_HEADER.size:
+            msg_type, length, _, reference = OIP_HEADER.unpack_from(buf)
+            if length < OIP_HEADER.size or length > self.MAX_LENGTH:
+                self.reset()
+                raise ValueError('Invalid OIP header: type={:#x}, '
+                                 'length={}'.format(msg_type, length))
+            if len(buf) < length:
+                break
+            frames.append((msg_type, reference,
+                           bytes(buf[OIP_HEADER.size:length])))
+            del buf[:length]
+        return frames
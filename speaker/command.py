@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""Decoding of action messages into validated commands."""
+
+import logging
+
+try:
+    import orjson
+    loads = orjson.loads
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+        JSON_BACKEND = 'ujson'
+    except ImportError:
+        import json
+        loads = json.loads
+        JSON_BACKEND = 'json'
+
+log = logging.getLogger(__name__)
+
+DEVICE_KINDS = ('SPK',)
+
+
+class CommandError(ValueError):
+    pass
+
+
+class Device(object):
+    """One device name, SPK_<zone> or SPK_<zone>_<task>.
+
+    zone is an int when numeric, else the zone name as given; task is
+    None when absent. server is the url of the server the device is
+    pinned to, None for the driver's default.
+    """
+
+    __slots__ = ('name', 'kind', 'zone', 'task', 'server')
+
+    def __init__(self, name, kind, zone, task=None, server=None):
+        self.name = name
+        self.kind = kind
+        self.zone = zone
+        self.task = task
+        self.server = server
+
+    def __repr__(self):
+        return 'Device({!r})'.format(self.name)
+
+
+def parse_name(name):
+    """Return the Device for name, raise CommandError if invalid."""
+    if not isinstance(name, str):
+        raise CommandError('Invalid speaker device name: {!r}'.format(name))
+    parts = name.split('_')
+    kind = parts[0].upper()
+    if kind not in DEVICE_KINDS or len(parts) not in (2, 3) or not parts[1]:
+        raise CommandError('Invalid speaker device name: {}'.format(name))
+    zone = parts[1]
+    if zone.isdigit():
+        zone = int(zone)
+    task = None
+    if len(parts) == 3:
+        if not parts[2].isdigit():
+            raise CommandError('Invalid speaker device name: {}'.format(name))
+        task = int(parts[2])
+    return Device(name, kind, zone, task)
+
+
+class Command(object):
+    """A decoded action message.
+
+    devices are the parsed targets in message order, invalid the names
+    that did not parse; status and priority are upper case, status is
+    None when empty.
+    """
+
+    __slots__ = ('devices', 'invalid', 'status', 'args', 'priority')
+
+    def __init__(self, devices, status=None, args=None, priority='',
+                 invalid=()):
+        self.devices = devices
+        self.invalid = list(invalid)
+        self.status = status
+        self.args = args
+        self.priority = priority
+
+    def __repr__(self):
+        return 'Command({}, {})'.format(
+            [d.name for d in self.devices] + self.invalid, self.status)
+
+    @classmethod
+    def from_dict(cls, mesg, registry=None):
+        """Validate mesg, names are resolved by registry if given."""
+        if not isinstance(mesg, dict):
+            raise CommandError('Message is not an object: {!r}'.format(mesg))
+        names = mesg.get('name')
+        if isinstance(names, str):
+            names = [names]
+        elif not isinstance(names, list) or not names:
+            raise CommandError('Message without device names: {!r}'.format(
+                mesg))
+        status = mesg.get('status')
+        if status is None or status == '':
+            status = None
+        elif isinstance(status, str):
+            status = status.strip().upper()
+        else:
+            raise CommandError('Invalid status: {!r}'.format(status))
+        priority = mesg.get('priority')
+        priority = str(priority).upper() if priority is not None else ''
+        devices = []
+        invalid = []
+        if registry is None:
+            for name in names:
+                try:
+                    devices.append(parse_name(name))
+                except CommandError as e:
+                    log.warning(e)
+                    invalid.append(str(name))
+        else:
+            seen = set()
+            for name in names:
+                try:
+                    expanded = registry.expand(name)
+                except CommandError as e:
+                    log.warning(e)
+                    invalid.append(str(name))
+                    continue
+                for device in expanded:
+                    if device.name not in seen:
+                        seen.add(device.name)
+                        devices.append(device)
+        if not devices:
+            raise CommandError('No valid device in {!r}'.format(names))
+        return cls(devices, status, mesg.get('args'), priority, invalid)
+
+    @classmethod
+    def decode(cls, data, registry=None):
+        """Command from a JSON message body."""
+        try:
+            mesg = loads(data)
+        except ValueError as e:
+            raise CommandError('Malformed JSON: {}'.format(e))
+        return cls.from_dict(mesg, registry)
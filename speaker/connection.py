@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""Reconnecting TCP client shared by the device drivers."""
+
+import asyncio
+import collections
+import itertools
+import logging
+import random
+import socket
+
+log = logging.getLogger(__name__)
+
+# TCP keepalive probing: idle seconds, probe interval, probe count
+TCP_KEEPALIVE = (10, 5, 3)
+
+
+class TcpClientProtocol(asyncio.Protocol):
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def connection_made(self, transport):
+        self.manager.connection_made(transport)
+
+    def data_received(self, data):
+        log.debug('Data received: {!r}'.format(data))
+        self.manager.master.data_received(data)
+
+    def connection_lost(self, exc):
+        log.error('The server closed the connection')
+        self.manager.connection_lost(exc)
+
+
+class ConnectionManager(object):
+    """Keep one TCP connection to a device open.
+
+    The first attempt is made at once; failed attempts are retried with
+    exponential backoff and jitter. A lost connection is retried after
+    a jittered delay too, and the backoff only starts over once a
+    session stayed up for stable_time seconds, so a peer that accepts
+    and then closes is not hammered. The master gets connection_made(),
+    data_received() and connection_lost() calls like a protocol, and
+    listeners are called with the new state on every change.
+    """
+
+    CONNECTING = 'connecting'
+    CONNECTED = 'connected'
+    DISCONNECTED = 'disconnected'
+
+    def __init__(self, loop, host, port, master,
+                 backoff=0.5, max_backoff=30.0, stable_time=10.0):
+        self.loop = loop or asyncio.get_event_loop()
+        self.host = host
+        self.port = port
+        self.master = master
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_time = stable_time
+        self.transport = None
+        self.state = self.DISCONNECTED
+        self.listeners = []
+        self.ready = asyncio.Event()
+        self.lost = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = self.loop.create_task(self._run())
+        return self.task
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.transport is not None:
+            self.transport.close()
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def _set_state(self, state):
+        self.state = state
+        for callback in self.listeners:
+            try:
+                callback(state)
+            except Exception as e:
+                log.error('Connection listener exception: {}'.format(e))
+
+    async def wait_connected(self, timeout=None):
+        """Wait until connected, return False on timeout."""
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _run(self):
+        delay = self.backoff
+        while True:
+            self._set_state(self.CONNECTING)
+            try:
+                await self.loop.create_connection(
+                    lambda: TcpClientProtocol(self), self.host, self.port)
+            except OSError as e:
+                self._set_state(self.DISCONNECTED)
+                wait = delay / 2 + random.uniform(0, delay / 2)
+                log.error('Connect to {}:{} failed: {}, retrying in '
+                          '{:.1f} seconds...'.format(self.host, self.port,
+                                                     e, wait))
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.max_backoff)
+                continue
+            started = self.loop.time()
+            await self.lost.wait()
+            if self.loop.time() - started >= self.stable_time:
+                delay = self.backoff
+            wait = delay / 2 + random.uniform(0, delay / 2)
+            log.warning('Connection to {}:{} lost, reconnecting in '
+                        '{:.1f} seconds...'.format(self.host, self.port,
+                                                   wait))
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, self.max_backoff)
+
+    def connection_made(self, transport):
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            self._tune(sock)
+        log.info('Connection create on {}:{}'.format(self.host, self.port))
+        self.transport = transport
+        self.lost.clear()
+        self.ready.set()
+        self._set_state(self.CONNECTED)
+        self.master.connection_made(transport)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.ready.clear()
+        self.lost.set()
+        self._set_state(self.DISCONNECTED)
+        self.master.connection_lost(exc)
+
+    def _tune(self, sock):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            idle, interval, count = TCP_KEEPALIVE
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+            if hasattr(socket, 'TCP_KEEPINTVL'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                                interval)
+            if hasattr(socket, 'TCP_KEEPCNT'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+        except OSError as e:
+            log.warning('Could not tune socket options: {}'.format(e))
+
+
+class CommandBuffer(object):
+    """Bounded queue of commands held while a device is disconnected.
+
+    A command put under the key of a queued one replaces it, since only
+    the latest state of a zone matters; commands without a key never
+    collapse. When full, the oldest command is dropped.
+    """
+
+    def __init__(self, maxlen=256):
+        self.maxlen = maxlen
+        self.items = collections.OrderedDict()
+        self.counter = itertools.count()
+        self.queued = 0
+        self.dropped = 0
+        self.collapsed = 0
+        self.flushed = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, key, item):
+        """Queue item, return the command it superseded or dropped."""
+        if key is None:
+            key = ('', next(self.counter))
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.collapsed += 1
+        elif len(self.items) >= self.maxlen:
+            _, old = self.items.popitem(last=False)
+            self.dropped += 1
+        self.items[key] = item
+        self.queued += 1
+        return old
+
+    def discard(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.collapsed += 1
+        return item
+
+    def drain(self):
+        items = list(self.items.values())
+        self.items.clear()
+        self.flushed += len(items)
+        return items
+
+    def get_info(self):
+        return {
+            'pending': len(self.items),
+            'queued': self.queued,
+            'dropped': self.dropped,
+            'collapsed': self.collapsed,
+            'flushed': self.flushed,
+        }
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""Ordered, bounded execution of device commands."""
+
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+
+log = logging.getLogger(__name__)
+
+EMERGENCY = 0
+ROUTINE = 1
+LANES = ('emergency', 'routine')
+
+
+class CommandScheduler(object):
+    """Run commands one at a time per device, at most concurrency at once.
+
+    Each device key has a FIFO per priority lane. Devices whose next
+    command is in the emergency lane are started before routine ones,
+    and an emergency command also goes ahead of routine commands already
+    queued for the same device. A group command is queued for each of
+    its devices and starts once it is next for all of them.
+    """
+
+    def __init__(self, loop=None, concurrency=16, maxsize=10000):
+        self.loop = loop or asyncio.get_event_loop()
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        # key -> one deque of jobs per lane
+        self.queues = {}
+        # (lane, seq, key) of devices with queued commands
+        self.ready = []
+        # keys of the running commands
+        self.active = set()
+        self.running = 0
+        self.counter = itertools.count()
+        self.lane_size = [0] * len(LANES)
+        self.size = 0
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+    def __len__(self):
+        return self.size
+
+    def full(self):
+        return self.size >= self.maxsize
+
+    def has_room(self, count=1):
+        """True if count more commands can be queued."""
+        return self.size + count <= self.maxsize
+
+    async def wait_not_full(self):
+        await self.not_full.wait()
+
+    def submit(self, key, func, *args, lane=ROUTINE):
+        """Queue func(*args) behind earlier commands for key.
+
+        Returns a future with the result; raises asyncio.QueueFull when
+        maxsize commands are already waiting.
+        """
+        return self._enqueue((key,), func, args, lane)
+
+    def submit_group(self, keys, func, *args, lane=ROUTINE):
+        """Queue func(*args) behind earlier commands for every key.
+
+        Later commands for any of the keys wait for it in turn.
+        """
+        keys = tuple(collections.OrderedDict.fromkeys(keys))
+        return self._enqueue(keys, func, args, lane)
+
+    def _enqueue(self, keys, func, args, lane):
+        if self.full():
+            raise asyncio.QueueFull()
+        fut = self.loop.create_future()
+        job = (func, args, fut, self.loop.time(), keys, lane)
+        for key in keys:
+            lanes = self.queues.get(key)
+            if lanes is None:
+                lanes = self.queues[key] = [collections.deque()
+                                            for _ in LANES]
+            lanes[lane].append(job)
+            if key not in self.active:
+                heapq.heappush(self.ready, (lane, next(self.counter), key))
+        self.lane_size[lane] += 1
+        self.size += 1
+        self.submitted += 1
+        if self.full():
+            self.not_full.clear()
+        self._pump()
+        return fut
+
+    def _head(self, key):
+        lanes = self.queues.get(key)
+        if lanes is None:
+            return None
+        for jobs in lanes:
+            if jobs:
+                return jobs[0]
+        return None
+
+    def _startable(self, job):
+        # jobs are next in the same (lane, submit) order on every key,
+        # so groups cannot wait on each other
+        return all(key not in self.active and self._head(key) is job
+                   for key in job[4])
+
+    def _take(self, job):
+        keys, lane = job[4], job[5]
+        for key in keys:
+            self.queues[key][lane].popleft()
+        self.lane_size[lane] -= 1
+        self.size -= 1
+        if not self.full():
+            self.not_full.set()
+
+    def _pump(self):
+        while self.ready and self.running < self.concurrency:
+            _, _, key = heapq.heappop(self.ready)
+            if key in self.active:
+                continue
+            job = self._head(key)
+            if job is None:
+                continue
+            if len(job[4]) > 1 and not self._startable(job):
+                # started when its last device gets free
+                continue
+            self._take(job)
+            self.active.update(job[4])
+            self.running += 1
+            self.loop.create_task(self._run(job))
+
+    async def _run(self, job):
+        func, args, fut, queued_at, keys, _ = job
+        wait = self.loop.time() - queued_at
+        self.started += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        try:
+            if not fut.cancelled():
+                result = await func(*args)
+                if not fut.done():
+                    fut.set_result(result)
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            log.error('Command for {} failed: {}'.format(keys, e))
+            if not fut.done():
+                fut.set_exception(e)
+        finally:
+            self.running -= 1
+            for key in keys:
+                self.active.discard(key)
+                self._requeue(key)
+            self._pump()
+
+    def _requeue(self, key):
+        lanes = self.queues.get(key)
+        if lanes is None:
+            return
+        for lane, jobs in enumerate(lanes):
+            if jobs:
+                heapq.heappush(self.ready, (lane, next(self.counter), key))
+                return
+        del self.queues[key]
+
+    def get_info(self):
+        started = self.started
+        return {
+            'pending': self.size,
+            'running': self.running,
+            'devices': len(self.queues),
+            'lanes': dict(zip(LANES, self.lane_size)),
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'wait_avg': self.wait_total / started if started else 0.0,
+            'wait_max': self.wait_max,
+        }
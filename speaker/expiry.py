@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""Deadline tracking for actions with an automatic release."""
+
+import heapq
+import itertools
+
+
+class ExpiryHeap(object):
+    """Min-heap of monotonic deadlines keyed by action name.
+
+    Rescheduling or cancelling a key leaves its old heap entry in place;
+    stale entries are skipped when they reach the top and the heap is
+    rebuilt once they outnumber the live ones.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def schedule(self, key, deadline):
+        old = self.entries.get(key)
+        if old is not None:
+            old[2] = None
+        entry = [deadline, next(self.counter), key]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        self._compact()
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry[2] = None
+            self._compact()
+
+    def deadline(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def next_deadline(self):
+        heap = self.heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][0]
+        return None
+
+    def pop_due(self, now):
+        due = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            _, _, key = heapq.heappop(heap)
+            if key is not None:
+                del self.entries[key]
+                due.append(key)
+        return due
+
+    def _compact(self):
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [e for e in self.heap if e[2] is not None]
+            heapq.heapify(self.heap)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""Registry of the speaker devices and groups known by name.
+
+The registry is loaded from a JSON file::
+
+    {
+        "devices": {
+            "SPK_101": {"driver": "spon", "terminal": 101,
+                        "server": "udp://10.0.0.2:2048",
+                        "groups": ["FLOOR_3"]},
+            "LOBBY": {"driver": "bosch", "zone": "Lobby"},
+            "SIREN_2": {"driver": "adam", "coil": 2, "task": 1}
+        },
+        "groups": {
+            "FLOOR_3": ["SPK_102", "SPK_110-160"]
+        }
+    }
+
+terminal, zone and coil are the same address under the name each
+driver uses. A group member NAME_<first>-<last> stands for the devices
+NAME_<first> to NAME_<last>. Names that are not registered are parsed
+as SPK_<zone>[_<task>] and kept in an LRU cache.
+"""
+
+import collections
+import json
+import logging
+
+from .command import Command, CommandError, Device, parse_name
+
+log = logging.getLogger(__name__)
+
+ADDRESS_KEYS = ('terminal', 'zone', 'coil')
+
+
+class DeviceRegistry(object):
+    """Name to Device lookup with group expansion."""
+
+    def __init__(self, cache_size=4096):
+        # name -> Device
+        self.devices = {}
+        # group name -> tuple of Devices
+        self.groups = {}
+        # names owned by another driver
+        self.foreign = {}
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.devices)
+
+    @classmethod
+    def load(cls, path, driver=None, **kwargs):
+        """Registry from a JSON file, keeping the devices of driver."""
+        with open(path) as f:
+            config = json.load(f)
+        registry = cls(**kwargs)
+        registry.configure(config, driver)
+        log.info('Loaded {} devices and {} groups from {}'.format(
+            len(registry.devices), len(registry.groups), path))
+        return registry
+
+    def configure(self, config, driver=None):
+        members = collections.OrderedDict()
+        for name, entry in config.get('devices', {}).items():
+            owner = entry.get('driver')
+            if driver and owner and owner.lower() != driver.lower():
+                self.foreign[name] = owner
+                continue
+            self.add(self._device(name, entry))
+            for group in entry.get('groups', ()):
+                members.setdefault(group, []).append(name)
+        for group, names in config.get('groups', {}).items():
+            members.setdefault(group, []).extend(names)
+        for group, names in members.items():
+            self.add_group(group, names)
+
+    def _device(self, name, entry):
+        zone = None
+        for key in ADDRESS_KEYS:
+            if key in entry:
+                zone = entry[key]
+                break
+        if zone is None:
+            # the address is in the name, SPK_<zone>[_<task>]
+            device = parse_name(name)
+            zone, task = device.zone, device.task
+        else:
+            task = None
+        task = entry.get('task', task)
+        if isinstance(zone, str) and zone.isdigit():
+            zone = int(zone)
+        if task is not None:
+            task = int(task)
+        return Device(name, entry.get('kind', 'SPK').upper(), zone, task,
+                      entry.get('server'))
+
+    def add(self, device):
+        self.devices[device.name] = device
+        self.cache.pop(device.name, None)
+
+    def add_group(self, group, names):
+        devices = []
+        seen = set()
+        for name in names:
+            for device in self._members(name):
+                if device.name not in seen:
+                    seen.add(device.name)
+                    devices.append(device)
+                    # members are looked up by name without the cache
+                    self.devices.setdefault(device.name, device)
+        self.groups[group] = tuple(devices)
+
+    def _members(self, name):
+        if name in self.devices or '-' not in name:
+            return [self._resolve(name)]
+        head, last = name.rsplit('-', 1)
+        first = self._resolve(head)
+        prefix = head[:head.rindex('_') + 1]
+        if not isinstance(first.zone, int) or not last.isdigit():
+            raise CommandError('Invalid device range: {}'.format(name))
+        return [self._resolve('{}{}'.format(prefix, zone))
+                for zone in range(first.zone, int(last) + 1)]
+
+    def _resolve(self, name):
+        device = self.devices.get(name)
+        if device is not None:
+            return device
+        if name in self.foreign:
+            raise CommandError('Device {} belongs to the {} driver'.format(
+                name, self.foreign[name]))
+        return parse_name(name)
+
+    def lookup(self, name):
+        """Return the Device of name, raise CommandError if unknown."""
+        device = self.devices.get(name)
+        if device is not None:
+            return device
+        device = self.cache.get(name)
+        if device is not None:
+            self.cache.move_to_end(name)
+            self.hits += 1
+            return device
+        device = self._resolve(name)
+        self.misses += 1
+        self.cache[name] = device
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return device
+
+    def expand(self, name):
+        """Devices of a group name, or the one device of name."""
+        if not isinstance(name, str):
+            raise CommandError('Invalid speaker device name: {!r}'.format(
+                name))
+        devices = self.groups.get(name)
+        if devices is not None:
+            return devices
+        return (self.lookup(name),)
+
+    def decode(self, data):
+        """Command.decode with names resolved by this registry."""
+        return Command.decode(data, self)
+
+    def get_info(self):
+        return {
+            'devices': len(self.devices),
+            'groups': {group: len(devices)
+                       for group, devices in self.groups.items()},
+            'cache': {
+                'size': len(self.cache),
+                'capacity': self.cache_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+        }
@@ -2,7 +2,11 @@
 """Router with RabbitMQ topic exchange"""
 
 import asyncio
+import collections
+import json
 import logging
+import os
+import random
 import asynqp
 from urllib.parse import urlparse
 
@@ -15,6 +19,11 @@ from urllib.parse import urlparse
 # EXCHANGE = 'sam.router'
 # QUEUE = 'sam.queue'
 RECONNECT_BACKOFF = 1.0
+RECONNECT_MAX_BACKOFF = 60.0
+# seconds a session must last before the backoff starts over
+RECONNECT_STABLE_TIME = 10.0
+# requeued messages whose retry count is remembered
+RETRY_TRACKED = 4096
 
 log = logging.getLogger(__name__)
 
@@ -32,7 +41,19 @@ class RouterMQ():
                  port=5672,
                  login='guest',
                  password='guest',
-                 virtualhost='/'):
+                 virtualhost='/',
+                 loop=None,
+                 buffer_size=1000,
+                 spill_path=None,
+                 prefetch=32,
+                 max_in_flight=64,
+                 requeue_delay=1.0,
+                 max_retries=5,
+                 backoff=RECONNECT_BACKOFF,
+                 max_backoff=RECONNECT_MAX_BACKOFF,
+                 decode=None,
+                 stable_time=RECONNECT_STABLE_TIME):
+        self.loop = loop or asyncio.get_event_loop()
         self.connection = None
         self.channel = None
         self.exchange = None
@@ -43,6 +64,44 @@ class RouterMQ():
         self.queue_name = queue_name or 'undefined'
         self.outgoing_key = outgoing_key
         self.callback = callback
+        # body -> message, ValueError rejects it; default is message.json()
+        self.decode = decode
+        # (routing key, message) waiting for the exchange, oldest first;
+        # overflow goes to spill_path as json lines if set, else dropped
+        self.outbox = collections.deque()
+        self.buffer_size = buffer_size
+        self.spill_path = spill_path
+        self.flush_handle = None
+        self.buffered = 0
+        self.published = 0
+        self.returned = 0
+        self.spilled = 0
+        self.dropped = 0
+        # messages are acked after the callback ran; unacked ones count
+        # against the broker prefetch, so a busy consumer gets no more
+        self.prefetch = prefetch
+        self.window = asyncio.Semaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.requeue_delay = requeue_delay
+        # (routing key, body) -> times requeued, for redelivered messages
+        self.max_retries = max_retries
+        self.retries = collections.OrderedDict()
+        self.flow = None
+        self.superseded = None
+        self.in_flight = 0
+        self.acked = 0
+        self.requeued = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.dropped_stale = 0
+        self.exhausted = 0
+        # set while connected and consuming; lost wakes the reconnector
+        self.ready = asyncio.Event()
+        self.lost = asyncio.Event()
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_time = stable_time
+        self.reconnects = 0
 
         _host = _port = _login = _password = _virtualhost = None
         if url:
@@ -59,6 +118,10 @@ class RouterMQ():
         self.MQ_PASSWORD = _password or password
         self.MQ_VIRTUAL_HOST = _virtualhost or virtualhost
         self.EXCHANGE = exchange
+        self.url = 'amqp://{}:******@{}:{}{}'.format(self.MQ_LOGIN,
+                                                     self.MQ_HOST,
+                                                     self.MQ_PORT,
+                                                     self.MQ_VIRTUAL_HOST)
 
     def get_info(self):
         return {
@@ -72,39 +135,95 @@ class RouterMQ():
             'routing_keys': self.routing_keys,
             'exchange': self.EXCHANGE,
             'type': 'AMQP',
+            'connected': self.ready.is_set(),
+            'reconnects': self.reconnects,
+            'publish': {
+                'pending': len(self.outbox),
+                'buffered': self.buffered,
+                'published': self.published,
+                'returned': self.returned,
+                'spilled': self.spilled,
+                'dropped': self.dropped,
+            },
+            'consume': {
+                'prefetch': self.prefetch,
+                'max_in_flight': self.max_in_flight,
+                'in_flight': self.in_flight,
+                'acked': self.acked,
+                'requeued': self.requeued,
+                'rejected': self.rejected,
+                'throttled': self.throttled,
+                'max_retries': self.max_retries,
+                'dropped_stale': self.dropped_stale,
+                'exhausted': self.exhausted,
+            },
         }
 
     def set_callback(self, callback):
-        """Set the function to process received message"""
+        """Set the function to process received message.
+
+        The message is requeued when the callback raises, returns False
+        or returns a dict with a true 'retry', and acked otherwise. It is
+        rejected for good once it was requeued max_retries times.
+        """
         self.callback = callback
 
+    def set_superseded(self, superseded):
+        """Ack instead of requeue when superseded(result) is true.
+
+        Called with the callback result after the requeue delay, e.g.
+        to drop a retry once a newer command reached the same devices.
+        """
+        self.superseded = superseded
+
+    def set_flow(self, flow):
+        """Hold messages while flow.full(), e.g. a command scheduler."""
+        self.flow = flow
+
     def connect(self):
         asyncio.ensure_future(self.reconnector())
 
+    async def wait_ready(self, timeout=None):
+        """Wait until connected, return False on timeout."""
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _connection_lost(self, exc):
+        log.error('RabbitMQ connection lost: {}'.format(exc))
+        # hold new events in the outbox until reconnected
+        self.exchange = None
+        self.ready.clear()
+        self.lost.set()
+
     async def _connect(self):
         """Connects to the amqp exchange and queue"""
         def log_returned_message(message):
             """Log when message has no handler in message queue"""
-
+            self.returned += 1
             log.warning("Nobody cared for {0} {1}".format(message.routing_key,
                                                           message.json()))
 
-        # self.connection = await asynqp.connect(
-        #     self.MQ_HOST,
-        #     int(self.MQ_PORT),
-        #     self.MQ_LOGIN,
-        #     self.MQ_PASSWORD,
-        #     self.MQ_VIRTUAL_HOST
-        # )
+        async def connection_closed(exc):
+            # late callbacks of an earlier connection are ignored
+            if self.connection is connection:
+                self._connection_lost(exc)
+
+        connection = None
         try:
-            self.connection = await asynqp.connect(
+            self.connection = connection = await asynqp.connect(
                 self.MQ_HOST,
                 int(self.MQ_PORT),
                 self.MQ_LOGIN,
                 self.MQ_PASSWORD,
-                self.MQ_VIRTUAL_HOST
+                self.MQ_VIRTUAL_HOST,
+                on_connection_close=connection_closed
             )
             self.channel = await self.connection.open_channel()
+            if self.prefetch:
+                await self.channel.set_qos(prefetch_count=self.prefetch)
             self.channel.set_return_handler(log_returned_message)
             self.exchange = await self.channel.declare_exchange(self.EXCHANGE,
                                                                 'topic')
@@ -113,38 +232,54 @@ class RouterMQ():
             for routing_key in self.routing_keys:
                 await self.queue.bind(self.exchange, routing_key)
             self.consumer = await self.queue.consume(self.handle_message)
+            self.lost.clear()
+            self.ready.set()
+            self._schedule_flush()
+            return True
         except asynqp.AMQPError as err:
-            log.error("Could not consume on queue".format(err))
-            if self.connection:
-                await self.connection.close()
+            log.error("Could not consume on queue: {}".format(err))
         except Exception as err:
             log.error('Amqp Connection Error: {}'.format(err))
-            if self.connection:
-                await self.connection.close()
+        self.exchange = None
+        if connection is not None:
+            self.connection = None
+            await connection.close()
+        return False
 
     async def reconnector(self):
+        """Connect, then sleep until the connection is lost.
+
+        Failed attempts and lost connections are retried with
+        exponential backoff and jitter, so a broker restart does not get
+        every client back at the same moment. The backoff only starts
+        over once a session stayed up for stable_time seconds.
+        """
+        delay = self.backoff
         try:
             while True:
-                if self.connection is None or self.connection.is_closed():
-                    url = 'amqp://{}:{}@{}:{}{}'.format(self.MQ_LOGIN,
-                                                        self.MQ_PASSWORD,
-                                                        self.MQ_HOST,
-                                                        self.MQ_PORT,
-                                                        self.MQ_VIRTUAL_HOST)
-                    log.info("Connecting to rabbitmq [{}] ...".format(url))
-                    try:
-                        await self._connect()
-                    except Exception as err:
-                        log.error("Failed to connect to rabbitmq Error: {} "
-                                  "Will retry in {} seconds"
-                                  .format(err, RECONNECT_BACKOFF))
-                        self.connection = None
-                    if self.connection is None:
-                        await asyncio.sleep(RECONNECT_BACKOFF)
-                    else:
-                        log.info("RabbitMQ Successfully connected. ")
-                # poll connection state every 100ms
-                await asyncio.sleep(0.5)
+                log.info("Connecting to rabbitmq [{}] ...".format(self.url))
+                try:
+                    connected = await self._connect()
+                except Exception as err:
+                    log.error("Failed to connect to rabbitmq Error: "
+                              "{}".format(err))
+                    connected = False
+                if not connected:
+                    wait = delay / 2 + random.uniform(0, delay / 2)
+                    log.error("Will retry in {:.1f} seconds".format(wait))
+                    await asyncio.sleep(wait)
+                    delay = min(delay * 2, self.max_backoff)
+                    continue
+                log.info("RabbitMQ Successfully connected. ")
+                started = self.loop.time()
+                await self.lost.wait()
+                self.reconnects += 1
+                if self.loop.time() - started >= self.stable_time:
+                    delay = self.backoff
+                wait = delay / 2 + random.uniform(0, delay / 2)
+                log.warning("Reconnecting in {:.1f} seconds".format(wait))
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.max_backoff)
         except asyncio.CancelledError:
             if self.connection is not None:
                 await self.connection.close()
@@ -154,26 +289,139 @@ class RouterMQ():
                 await self.connection.close()
 
     def publish(self, mesg, outgoing_key=None):
-        """Route publish packet from client to message queue"""
+        """Queue a message for the exchange, sent on the next loop tick.
+
+        While the broker is away messages wait in the outbox and are
+        sent after reconnecting.
+        """
+        key = outgoing_key or self.outgoing_key or ''
+        if len(self.outbox) >= self.buffer_size:
+            self._overflow(self.outbox.popleft())
+        self.outbox.append((key, mesg))
+        self.buffered += 1
+        self._schedule_flush()
+
+    def _overflow(self, item):
+        if self.spill_path:
+            try:
+                with open(self.spill_path, 'a') as f:
+                    f.write(json.dumps(item) + '\n')
+                self.spilled += 1
+                return
+            except (OSError, TypeError, ValueError) as err:
+                log.error('Could not spill message: {}'.format(err))
+        self.dropped += 1
+        log.warning('Publish buffer full, dropped {}'.format(item))
+
+    def _unspill(self):
+        """Put spilled messages back in front of the outbox."""
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
         try:
-            key = outgoing_key or self.outgoing_key or ''
-            msg = asynqp.Message(mesg, content_encoding='utf-8')
-            if self.exchange:
+            with open(self.spill_path) as f:
+                items = [tuple(json.loads(line)) for line in f if line]
+            os.remove(self.spill_path)
+        except (OSError, ValueError) as err:
+            log.error('Could not read spilled messages: {}'.format(err))
+            return
+        self.outbox.extendleft(reversed(items))
+
+    def _schedule_flush(self):
+        if self.flush_handle is None and self.exchange:
+            self.flush_handle = self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        # everything published during one loop tick goes out together
+        self.flush_handle = None
+        if not self.exchange:
+            return
+        self._unspill()
+        outbox = self.outbox
+        while outbox and self.exchange:
+            key, mesg = outbox[0]
+            try:
+                msg = asynqp.Message(mesg, content_encoding='utf-8')
+            except Exception as err:
+                log.error('Could not publish {}: {}'.format(mesg, err))
+                outbox.popleft()
+                self.dropped += 1
+                continue
+            try:
                 self.exchange.publish(msg, key)
-                log.debug("To %s: %s", key, mesg)
-            else:
-                log.error("Could not publish, because exchange is not exist")
-        except Exception as err:
-            log.error('Could not publish, because some error: {}'.format(err))
+            except Exception as err:
+                log.error('Could not publish, '
+                          'because some error: {}'.format(err))
+                break
+            outbox.popleft()
+            self.published += 1
+            log.debug("To %s: %s", key, mesg)
 
     def handle_message(self, message):
         """Handle message coming from rabbitmq and route them to the
            respective clients"""
-        routing_key = message.routing_key
-        json = message.json()
-        log.debug("From [%s] %s", routing_key, json)
-        if self.callback:
-            asyncio.ensure_future(self.callback(json))
+        self.in_flight += 1
+        self.loop.create_task(self._dispatch(message))
+
+    async def _dispatch(self, message):
+        try:
+            routing_key = message.routing_key
+            try:
+                if self.decode is not None:
+                    json = self.decode(message.body)
+                else:
+                    json = message.json()
+            except ValueError as err:
+                log.error('Malformed message from [{}]: {}'.format(
+                    routing_key, err))
+                message.reject(requeue=False)
+                self.rejected += 1
+                return
+            log.debug("From [%s] %s", routing_key, json)
+            if not self.callback:
+                message.ack()
+                self.acked += 1
+                return
+            async with self.window:
+                if self.flow is not None and self.flow.full():
+                    self.throttled += 1
+                    await self.flow.wait_not_full()
+                try:
+                    result = await self.callback(json)
+                except Exception as err:
+                    log.error('Message handler error: {}'.format(err))
+                    result = False
+            key = (routing_key, message.body)
+            tries = self.retries.pop(key, 0) if message.redelivered else 0
+            if result is False or (isinstance(result, dict) and
+                                   result.get('retry')):
+                if tries >= self.max_retries:
+                    log.error('Giving up on [{}] after {} retries: '
+                              '{}'.format(routing_key, tries, json))
+                    message.reject(requeue=False)
+                    self.exhausted += 1
+                    return
+                # give the device a moment before the broker redelivers
+                await asyncio.sleep(self.requeue_delay)
+                if (self.superseded is not None and
+                        self.superseded(result)):
+                    log.info('Newer command replaced [{}] {}, not '
+                             'retried'.format(routing_key, json))
+                    message.ack()
+                    self.dropped_stale += 1
+                    return
+                self.retries[key] = tries + 1
+                if len(self.retries) > RETRY_TRACKED:
+                    # redelivered to another consumer, or purged
+                    self.retries.popitem(last=False)
+                message.reject(requeue=True)
+                self.requeued += 1
+            else:
+                message.ack()
+                self.acked += 1
+        except Exception as err:
+            log.error('Could not settle message: {}'.format(err))
+        finally:
+            self.in_flight -= 1
 
 
 def main(debug=True):
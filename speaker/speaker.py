@@ -3,22 +3,62 @@
 """Main module."""
 
 import logging
+import sys
 import time
 import asyncio
+from .actions import ActionState, ActionTable
+from .command import Command, CommandError
+from .dispatcher import CommandScheduler, EMERGENCY, ROUTINE
+from .expiry import ExpiryHeap
+from .registry import DeviceRegistry
 log = logging.getLogger(__name__)
 
 
 class SpeakerV1():
-    def __init__(self, loop=None):
+    # message priorities that jump ahead of routine commands
+    EMERGENCY_PRIORITIES = ('EMERGENCY', 'EVACUATION')
+    # drivers able to send one group frame for a list of devices
+    supports_batch = False
+    # a repeat of these for a device already in them skips the device
+    DEDUP_STATUSES = ('AUTO', 'ON')
+
+    def __init__(self, loop=None, concurrency=16, registry=None,
+                 actions=None):
         self.loop = loop or asyncio.get_event_loop()
-        self.actions = {}
+        if registry is None:
+            registry = DeviceRegistry()
+        self.registry = registry
+        if actions is None:
+            actions = ActionTable()
+        self.actions = actions
+        self.scheduler = CommandScheduler(self.loop, concurrency)
+        self.expiry = ExpiryHeap()
+        self.release_timer = None
+        self.release_deadline = None
+        self.running = False
+        self.publish = None
+        # release time of AUTO actions, set by the drivers
+        self.timeout = 0
+        # device -> status the driver last applied successfully
+        self.settled = {}
+        self.dedup_hits = 0
+        self.dedup_misses = 0
 
     def __str__(self):
         return "Speaker V1"
 
     def get_info(self):
         return {
-            'actions': self.actions
+            'actions': {act: state.to_dict()
+                        for act, state in self.actions.items()},
+            'action_table': self.actions.get_info(),
+            'scheduler': self.scheduler.get_info(),
+            'registry': self.registry.get_info(),
+            'dedup': {
+                'hits': self.dedup_hits,
+                'misses': self.dedup_misses,
+                'settled': len(self.settled)
+            }
         }
 
     def set_publish(self, publish):
@@ -28,68 +68,168 @@ class SpeakerV1():
             self.publish = None
 
     def start(self):
-        self._auto_loop()
+        self.running = True
+        self._arm_release()
 
-    def _auto_loop(self):
-        self._update_actions()
-        log.debug('Actions: {}'.format(self.actions))
-        self.loop.call_later(1, self._auto_loop)
+    def next_deadline(self):
+        """Loop time of the next automatic release, None if idle."""
+        return self.expiry.next_deadline()
 
-    def _register(self, act, status, timeout):
-        self.actions[act] = {
-            'status': status,
-            'timeout': int(timeout),
-            'timestamp': self._time_stamp()
-        }
+    def _arm_release(self):
+        if not self.running:
+            return
+        deadline = self.expiry.next_deadline()
+        if self.release_timer is not None:
+            if self.release_deadline == deadline:
+                return
+            self.release_timer.cancel()
+            self.release_timer = None
+        self.release_deadline = deadline
+        if deadline is not None:
+            self.release_timer = self.loop.call_at(deadline,
+                                                   self._auto_release)
 
-    def _update_actions(self):
-        for act, val in self.actions.items():
-            timeout = val.get('timeout', 0)
-            _status = val.get('status')
-            _time_stamp = val.get('timestamp')
-            if timeout >= 1:
-                timeout -= 1
-                if timeout <= 1:
-                    self._release(act)
-                    _status = 'Off/Stop'
-                    _time_stamp = self._time_stamp()
-                self.actions[act] = {
-                    'status': _status,
-                    'timeout': int(timeout),
-                    'timestamp': _time_stamp
-                }
-
-    def _time_stamp(self):
-        t = time.localtime()
-        time_stamp = '%d-%02d-%02d %02d:%02d:%02d' % (t.tm_year,
-                                                      t.tm_mon,
-                                                      t.tm_mday,
-                                                      t.tm_hour,
-                                                      t.tm_min,
-                                                      t.tm_sec)
-        return time_stamp
+    def _auto_release(self):
+        self.release_timer = None
+        for act in self.expiry.pop_due(self.loop.time()):
+            try:
+                self._release(act)
+            except Exception as e:
+                log.error('Speaker _release() exception: {}'.format(e))
+            self.settled.pop(act, None)
+            self.actions[act] = ActionState('Off/Stop')
+        self._arm_release()
+
+    def _register(self, act, status, timeout):
+        act = sys.intern(act)
+        now = time.time()
+        release_at = None
+        if timeout > 0:
+            self.expiry.schedule(act, self.loop.time() + timeout)
+            release_at = now + timeout
+        else:
+            self.expiry.cancel(act)
+        self.actions[act] = ActionState(status, timeout, now, release_at)
+        self._arm_release()
 
     async def got_command(self, mesg):
+        """Run a Command, or a message dict decoded into one."""
         try:
             log.info('Speaker received: {}'.format(mesg))
-            action = mesg.get('name')
-            if action is None:
-                return None
-            args = mesg.get('args')
-            status = mesg.get('status')
-            if status is '':
-                status = None
+            if not isinstance(mesg, Command):
+                mesg = Command.from_dict(mesg, self.registry)
+            if mesg.priority in self.EMERGENCY_PRIORITIES:
+                lane = EMERGENCY
+            else:
+                lane = ROUTINE
+            args = mesg.args
+            status = mesg.status
+            results = {}
+            devices = self._dedup(mesg.devices, status, results)
+            if not devices:
+                sent = {}
+            elif len(devices) > 1 and self.supports_batch:
+                sent = await self.scheduler.submit_group(
+                    [device.name for device in devices],
+                    self._do_batch, devices, args, status, lane=lane)
             else:
-                status = status.upper()
-            if type(action) is list:
-                for act in action:
-                    await self._do_action(act, args, status)
-            elif type(action) is str:
-                await self._do_action(action, args, status)
+                # all devices or none, a requeued message runs them again
+                if not self.scheduler.has_room(len(devices)):
+                    raise asyncio.QueueFull()
+                sent = await asyncio.gather(
+                    *[self._submit(device, args, status, lane)
+                      for device in devices],
+                    return_exceptions=True)
+                sent = dict(zip((device.name for device in devices), sent))
+            for name, result in sent.items():
+                if result is True:
+                    self.settled[name] = status
+            results.update(sent)
+            for name in mesg.invalid:
+                results[name] = CommandError(
+                    'Invalid speaker device name: {}'.format(name))
+            summary = self._summary(results)
+            # read by superseded() before the message is retried
+            summary['devices'] = list(results)
+            summary['time'] = time.time()
+            return summary
+        except CommandError as e:
+            log.warning('Speaker rejected command: {}'.format(e))
+        except asyncio.QueueFull:
+            log.warning('Speaker command queue full: {}'.format(mesg))
+            return False
         except Exception as e:
             log.error('Speaker do_action() exception: {}'.format(e))
 
-    async def _do_action(self, act, args, status):
+    def _dedup(self, devices, status, results):
+        """Devices that need I/O for status.
+
+        A device the driver already put in a DEDUP_STATUSES status only
+        gets its release deadline extended and a True result.
+        """
+        fresh = []
+        for device in devices:
+            name = device.name
+            if status not in self.DEDUP_STATUSES:
+                self.settled.pop(name, None)
+                fresh.append(device)
+                continue
+            state = self.actions.get(name)
+            if (self.settled.get(name) == status and state is not None and
+                    state.status == status):
+                if status == 'AUTO':
+                    self._register(name, status, self.timeout)
+                results[name] = True
+                self.dedup_hits += 1
+            else:
+                # not settled until the driver succeeds again
+                self.settled.pop(name, None)
+                fresh.append(device)
+                self.dedup_misses += 1
+        return fresh
+
+    def _summary(self, results):
+        failed = {}
+        retry = False
+        for act, result in results.items():
+            if result is True:
+                continue
+            if isinstance(result, Exception):
+                failed[act] = str(result)
+            else:
+                failed[act] = 'no reply'
+            # a timeout or driver error is worth a retry, a bad name is not
+            if not isinstance(result, CommandError):
+                retry = True
+        summary = {
+            'total': len(results),
+            'ok': len(results) - len(failed),
+            'failed': failed,
+            'retry': retry
+        }
+        if failed:
+            log.warning('Speaker command summary: {}'.format(summary))
+        return summary
+
+    def superseded(self, summary):
+        """True if a device of summary got a newer command since."""
+        done = summary.get('time', 0)
+        for name in summary.get('devices', ()):
+            state = self.actions.get(name)
+            if state is not None and state.changed > done:
+                return True
+        return False
+
+    def _submit(self, device, args, status, lane=ROUTINE):
+        return self.scheduler.submit(device.name, self._do_action, device,
+                                     args, status, lane=lane)
+
+    async def _do_action(self, device, args, status):
+        """Apply status to device, return True once the device took it."""
+        raise NotImplementedError
+
+    async def _do_batch(self, devices, args, status):
+        """Send one group frame for devices, return {name: True/False}."""
         raise NotImplementedError
 
     def _release(self, act, args, status):
@@ -4,6 +4,7 @@
 
 import logging
 from urllib.parse import urlparse
+from .command import CommandError
 from .speaker import SpeakerV1
 from .adam import Adam
 log = logging.getLogger(__name__)
@@ -16,58 +17,66 @@ class Speaker_Adam(SpeakerV1):
 
     CLIENT_UDP_TIMEOUT = 5.0
 
-    def __init__(self, loop, spk_svr, release_time=20):
-        super().__init__(loop)
+    def __init__(self, loop, spk_svr, release_time=20, poll_interval=10,
+                 registry=None, actions=None):
+        super().__init__(loop, registry=registry, actions=actions)
         _url = urlparse(spk_svr)
         self.host = _url.hostname or 'localhost'
         self.port = _url.port or 502
         self.timeout = release_time
-        self.server = Adam(loop, self.host, self.port)
+        self.server = Adam(loop, self.host, self.port,
+                           poll_interval=poll_interval,
+                           on_change=self._coils_changed)
 
     def __str__(self):
         return "Speaker V1 and Adam-6017 to triger speaker system"
 
-    async def _do_action(self, act, args=None, status=None):
-        act_list = act.split('_')
-        if (len(act_list) < 2):
-            log.warn('Invalid speaker device name: {}'.format(act))
-            return False
-        if act_list[0].upper() != 'SPK':
-            log.warn('Invalid speaker device name: {}'.format(act))
-            return False
+    def get_info(self):
+        info = super().get_info()
+        info['server'] = self.server.get_info()
+        return info
 
+    async def _do_action(self, device, args=None, status=None):
+        act = device.name
+        if not isinstance(device.zone, int):
+            raise CommandError('Invalid speaker device name: {}'.format(act))
         # SPK_zone_task or SPK_zone
-        if len(act_list) == 2:
-            zone = int(act_list[1])
-            dest_id = 0
-        else:
-            zone = int(act_list[1])
-            dest_id = int(act_list[2])
+        zone = device.zone
+        dest_id = device.task or 0
         if status == 'AUTO':
-            self._register(act, status, self.timeout+1)
+            self._register(act, status, self.timeout)
         else:
             self._register(act, status, 0)
         if status == 'OFF':
             cmd = 'OFF'
         else:
             cmd = 'ON'
-        if self.server:
-            self.server.alarm_task(cmd, dest_id, zone)
-            # log.info('Received from speaker server: {}'.format(reps))
-        else:
+        if not self.server:
             log.error('invalid speaker server.')
+            return False
+        return bool(await self._alarm_task(cmd, dest_id, zone))
+
+    async def _alarm_task(self, cmd, dest_id, zone=0):
+        reps = await self.server.alarm_task(cmd, dest_id, zone)
+        log.info('Received from speaker server: {}'.format(reps))
+        return reps
+
+    def _coils_changed(self, changes):
+        if not self.publish:
+            return
+        for zone, on in changes:
+            self.publish({'name': 'SPK_{}'.format(zone),
+                          'status': 'ON' if on else 'OFF'})
 
     def _release(self, act, args=None, status='OFF'):
-        act_list = act.split('_')
-        if (len(act_list) < 2):
-            log.warn('Invalid speaker device name: {}'.format(act))
+        try:
+            device = self.registry.lookup(act)
+        except CommandError as e:
+            log.warn(e)
             return False
-        if act_list[0].upper() != 'SPK':
-            log.warn('Invalid speaker device name: {}'.format(act))
+        if not isinstance(device.zone, int):
             return False
-        dest_id = int(act_list[1])
         if self.server:
-            reps = self.server.alarm_task('RELEASE', dest_id)
-            log.info('Received from speaker server: {}'.format(reps))
+            self.loop.create_task(self._alarm_task('OFF', 0, device.zone))
         else:
             log.error('invalid speaker server.')
@@ -4,8 +4,10 @@
 
 import logging
 from urllib.parse import urlparse
+from .command import CommandError
 from .speaker import SpeakerV1
 from .bosch import Bosch
+from .connection import ConnectionManager
 log = logging.getLogger(__name__)
 
 
@@ -17,55 +19,89 @@ class Speaker_Bosch(SpeakerV1):
     CLIENT_UDP_TIMEOUT = 5.0
 
     def __init__(self, loop, spk_svr, release_time=20,
-                 user='admin', passwd='admin'):
-        super().__init__(loop)
+                 user='admin', passwd='admin',
+                 priority=80, message='xiaofang', registry=None,
+                 actions=None):
+        super().__init__(loop, registry=registry, actions=actions)
         _url = urlparse(spk_svr)
         self.host = _url.hostname or 'localhost'
         self.port = _url.port or 2048
         self.timeout = release_time
         self.server = Bosch(self.loop,
                             self.host, self.port,
-                            user, passwd)
+                            user, passwd,
+                            priority, message)
+        # action -> id of the call running on its zone; the controller
+        # ends every call with the session
+        self.calls = {}
+        self.server.conn.add_listener(self._connection_state)
 
     def __str__(self):
         return "Speaker V1 and Bosch system"
 
-    async def _do_action(self, act, args=None, status=None):
-        act_list = act.split('_')
-        if (len(act_list) < 2):
-            log.warn('Invalid speaker device name: {}'.format(act))
-            return False
-        if act_list[0].upper() != 'SPK':
-            log.warn('Invalid speaker device name: {}'.format(act))
-            return False
-        dest_id = int(act_list[1])
+    async def _do_action(self, device, args=None, status=None):
+        act = device.name
+        zone = str(device.zone)
         if status == 'AUTO':
-            self._register(act, status, self.timeout+1)
+            self._register(act, status, self.timeout)
         else:
             self._register(act, status, 0)
         if status == 'OFF':
             cmd = 'stop'
         else:
             cmd = 'start'
-        log.debug('Cmd: {}, dest_id: {}'.format(cmd, dest_id))
-        if self.server:
-            reps = self.server.startCall()
-            log.info('Received from speaker server: {}'.format(reps))
-        else:
+        log.debug('Cmd: {}, zone: {}'.format(cmd, zone))
+        if not self.server:
             log.error('invalid speaker server.')
+            return False
+        if cmd == 'stop':
+            # written, or buffered until the server is back
+            self._stop_call(act, zone)
+            return True
+        if act in self.calls:
+            log.debug('Call {} already running on {}'.format(self.calls[act],
+                                                             zone))
+            return True
+        call_id = await self.server.startCall([zone])
+        log.info('Received from speaker server: {}'.format(call_id))
+        if call_id is None:
+            return False
+        state = self.actions.get(act)
+        if state is not None and state.status == 'OFF':
+            # stopped while the call was being set up
+            self.server.stopCall(call_id, [zone])
+        else:
+            self.calls[act] = call_id
+        return True
+
+    def _connection_state(self, state):
+        if state != ConnectionManager.DISCONNECTED or not self.calls:
+            return
+        log.warning('Session lost, calls ended: {}'.format(self.calls))
+        for act in self.calls:
+            # started again by the next command, not skipped as a repeat
+            self.settled.pop(act, None)
+        self.calls.clear()
+
+    def get_info(self):
+        info = super().get_info()
+        info['server'] = self.server.get_info()
+        return info
+
+    def _stop_call(self, act, zone):
+        call_id = self.calls.pop(act, None)
+        if call_id is not None:
+            self.server.stopCall(call_id, [zone])
+        else:
+            self.server.cancelCall([zone])
 
     def _release(self, act, args=None, status='OFF'):
-        # act_list = act.split('_')
-        # if (len(act_list) < 2):
-        #     log.warn('Invalid speaker device name: {}'.format(act))
-        #     return False
-        # if act_list[0].upper() != 'SPK':
-        #     log.warn('Invalid speaker device name: {}'.format(act))
-        #     return False
-        # dest_id = int(act_list[1])
-        # if self.server:
-        #     reps = self.server.alarm_task('stop', dest_id)
-        #     log.info('Received from speaker server: {}'.format(reps))
-        # else:
-        #     log.error('invalid speaker server.')
-        return
+        try:
+            device = self.registry.lookup(act)
+        except CommandError as e:
+            log.warn(e)
+            return False
+        if self.server:
+            self._stop_call(act, str(device.zone))
+        else:
+            log.error('invalid speaker server.')
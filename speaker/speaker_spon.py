@@ -2,65 +2,257 @@
 
 """Main module."""
 
+import asyncio
 import logging
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, urlparse
+from .command import CommandError
 from .speaker import SpeakerV1
-from .spon import Spon
+from .spon import Spon, SponCluster, TerminalSet
 log = logging.getLogger(__name__)
 
 
+def parse_terminals(spec):
+    """Parse '1-200,305' into ([(1, 200)], [305])."""
+    ranges = []
+    terminals = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            ranges.append((int(first), int(last)))
+        else:
+            terminals.append(int(part))
+    return ranges, terminals
+
+
 class Speaker_Spon(SpeakerV1):
     """
     Spon Speaker system driver for SAM V1
     """
 
     CLIENT_UDP_TIMEOUT = 5.0
+    supports_batch = True
 
-    def __init__(self, loop, spk_svr, release_time=20):
-        super().__init__(loop)
-        _url = urlparse(spk_svr)
-        self.host = _url.hostname or 'localhost'
-        self.port = _url.port or 2048
+    def __init__(self, loop, spk_svr, release_time=20, batch_window=0.02,
+                 concurrency=1024, registry=None, actions=None,
+                 active_ttl=10.0):
+        # commands only wait in the batch window, so many may run at once
+        super().__init__(loop, concurrency, registry, actions)
         self.timeout = release_time
-        self.server = Spon(self.host, self.port)
+        self.cluster = self._make_cluster(spk_svr)
+        self._pin_devices()
+        self.server = self.cluster.default or self.cluster.servers[0]
+        self.host, self.port = self.server.server_address
+        self.batch_window = batch_window
+        # cmd -> {dest_id: [futures]} collected in the current window
+        self.batch = {'stop': {}, 'start': {}}
+        self.batch_timer = None
+        # (server, cmd) -> lock, one broadcast of each action in flight
+        # per server so its replies cannot be matched to another frame
+        self.sending = {}
+        # terminals the server acknowledged as playing, in two
+        # generations rotated every active_ttl / 2 seconds: a terminal
+        # stopped at the console is started again once its entry aged
+        self.active = TerminalSet()
+        self.active_old = TerminalSet()
+        self.active_ttl = active_ttl
+        self.rotated = self.loop.time()
+        self.batched = 0
+        self.frames_sent = 0
+        self.skipped = 0
 
     def __str__(self):
         return "Speaker V1 and Spon system"
 
-    async def _do_action(self, act, args=None, status=None):
-        act_list = act.split('_')
-        if (len(act_list) < 2):
-            log.warn('Invalid speaker device name: {}'.format(act))
-            return False
-        if act_list[0].upper() != 'SPK':
-            log.warn('Invalid speaker device name: {}'.format(act))
-            return False
-        dest_id = int(act_list[1])
+    def _make_cluster(self, spk_svr):
+        """Servers from ';' separated urls.
+
+        A url may own terminals with ?terminals=1-200,305; the first
+        url without them gets all other terminals.
+        """
+        cluster = SponCluster()
+        for url in spk_svr.split(';'):
+            url = url.strip()
+            if not url:
+                continue
+            _url = urlparse(url)
+            server = Spon(self.loop, _url.hostname or 'localhost',
+                          _url.port or 2048)
+            spec = parse_qs(_url.query).get('terminals')
+            if spec:
+                cluster.add(server, *parse_terminals(spec[0]))
+            elif cluster.default is None:
+                cluster.default = server
+                cluster.add(server)
+            else:
+                log.warning('Spon server {} owns no terminals, '
+                            'ignored'.format(url))
+        if not len(cluster):
+            cluster.default = Spon(self.loop, 'localhost', 2048)
+            cluster.add(cluster.default)
+        return cluster
+
+    def _pin_devices(self):
+        """Route registry devices that name a server to that server."""
+        servers = {server.server_address: server
+                   for server in self.cluster.servers}
+        for device in self.registry.devices.values():
+            if device.server is None or not isinstance(device.zone, int):
+                continue
+            _url = urlparse(device.server)
+            address = (_url.hostname or 'localhost', _url.port or 2048)
+            server = servers.get(address)
+            if server is None:
+                server = Spon(self.loop, *address)
+                servers[address] = server
+            self.cluster.add(server, terminals=[device.zone])
+
+    def get_info(self):
+        info = super().get_info()
+        info['servers'] = self.cluster.get_info()
+        info['batch'] = {
+            'window': self.batch_window,
+            'commands': self.batched,
+            'frames': self.frames_sent,
+            'skipped': self.skipped,
+            'active': len(self._playing()),
+            'active_ttl': self.active_ttl
+        }
+        return info
+
+    def _command(self, device, status):
+        if not isinstance(device.zone, int):
+            raise CommandError('Invalid speaker device name: {}'.format(
+                device.name))
         if status == 'AUTO':
-            self._register(act, status, self.timeout+1)
+            self._register(device.name, status, self.timeout)
         else:
-            self._register(act, status, 0)
+            self._register(device.name, status, 0)
         if status == 'OFF':
             cmd = 'stop'
         else:
             cmd = 'start'
-        if self.server:
-            reps = self.server.alarm_task(cmd, dest_id)
-            log.info('Received from speaker server: {}'.format(reps))
-        else:
-            log.error('invalid speaker server.')
+        return self._queue(cmd, device.zone)
+
+    async def _do_action(self, device, args=None, status=None):
+        return await self._command(device, status)
+
+    async def _do_batch(self, devices, args=None, status=None):
+        results = {}
+        futs = {}
+        for device in devices:
+            try:
+                futs[device.name] = self._command(device, status)
+            except CommandError as e:
+                log.warn(e)
+                results[device.name] = e
+        if futs:
+            replies = await asyncio.gather(*futs.values())
+            results.update(zip(futs, replies))
+        return results
+
+    def _queue(self, cmd, dest_id):
+        """Add a start/stop to the current window, return its future.
+
+        A later command for the same terminal replaces an earlier one
+        still waiting in the window.
+        """
+        fut = self.loop.create_future()
+        for other, dests in self.batch.items():
+            if other != cmd and dest_id in dests:
+                waiters = dests.pop(dest_id)
+                self.batch[cmd].setdefault(dest_id, []).extend(waiters)
+        self.batch[cmd].setdefault(dest_id, []).append(fut)
+        self.batched += 1
+        if self.batch_timer is None:
+            self.batch_timer = self.loop.call_later(self.batch_window,
+                                                    self._flush_batch)
+        return fut
+
+    def _flush_batch(self):
+        self.batch_timer = None
+        batch, self.batch = self.batch, {'stop': {}, 'start': {}}
+        for cmd, dests in batch.items():
+            if not dests:
+                continue
+            # one task per server, so hosts are served in parallel
+            groups, unrouted = self.cluster.split(dests)
+            for server, group in groups.items():
+                self.loop.create_task(self._send_batch(
+                    server, cmd, {d: dests[d] for d in group}))
+            if unrouted:
+                log.error('No Spon server for terminals {}'.format(unrouted))
+                self._resolve({d: dests[d] for d in unrouted}, False)
+
+    async def _send_batch(self, server, cmd, dests):
+        ok = False
+        lock = self.sending.get((server, cmd))
+        if lock is None:
+            lock = self.sending[(server, cmd)] = asyncio.Lock()
+        try:
+            async with lock:
+                ok = await self._broadcast(server, cmd, list(dests))
+        except Exception as e:
+            log.error('Speaker broadcast exception: {}'.format(e))
+        self._resolve(dests, ok)
+
+    def _resolve(self, dests, ok):
+        for waiters in dests.values():
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_result(ok)
+
+    async def _broadcast(self, server, cmd, dests):
+        """Send cmd to dests, True once every frame was answered."""
+        # terminals up to 1000 are always addressed by the 0xC3 extend
+        # bitmap, so a stop undoes its start whatever the group was;
+        # others only exist as 0xCA alarm tasks
+        frames = [server.alarm_task(cmd, d) for d in dests if d > 1000]
+        terms = TerminalSet(d for d in dests if d <= 1000)
+        if cmd == 'start':
+            # only the delta to the playing terminals goes on the wire;
+            # stops are always sent in case a terminal was started
+            # from somewhere else
+            start = terms - self._playing()
+            self.skipped += len(terms) - len(start)
+            terms = start
+        if terms:
+            frames.append(server.broadcast_extend(cmd, terms))
+        if not frames:
+            # every terminal is playing already
+            return True
+        self.frames_sent += len(frames)
+        reps = await asyncio.gather(*frames)
+        log.info('Received from speaker server: {}'.format(reps))
+        if terms and reps[-1] is not None:
+            if cmd == 'start':
+                self.active = self.active | terms
+            else:
+                self.active = self.active - terms
+                self.active_old = self.active_old - terms
+        return all(rep is not None for rep in reps)
+
+    def _playing(self):
+        """Terminals started within the last active_ttl seconds."""
+        now = self.loop.time()
+        age = now - self.rotated
+        if age >= self.active_ttl / 2:
+            if age >= self.active_ttl:
+                self.active_old = TerminalSet()
+            else:
+                self.active_old = self.active
+            self.active = TerminalSet()
+            self.rotated = now
+        return self.active | self.active_old
 
     def _release(self, act, args=None, status='OFF'):
-        act_list = act.split('_')
-        if (len(act_list) < 2):
-            log.warn('Invalid speaker device name: {}'.format(act))
+        try:
+            device = self.registry.lookup(act)
+        except CommandError as e:
+            log.warn(e)
             return False
-        if act_list[0].upper() != 'SPK':
-            log.warn('Invalid speaker device name: {}'.format(act))
+        if not isinstance(device.zone, int):
             return False
-        dest_id = int(act_list[1])
-        if self.server:
-            reps = self.server.alarm_task('stop', dest_id)
-            log.info('Received from speaker server: {}'.format(reps))
-        else:
-            log.error('invalid speaker server.')
+        self._queue('stop', device.zone)
@@ -1,16 +1,148 @@
 #!/usr/bin/env python3
 # _*_ coding: utf-8 _*_
 
+import asyncio
+import bisect
+import collections
+import itertools
 import logging
-import socket
-import struct
+from .codec import (SPON_ALARM_TASK, SPON_BROADCAST, SPON_CONTROL_BYTES,
+                    SPON_EXTEND_BYTES, SPON_HEAD, SPON_TERMINAL_CONTROL,
+                    spon_encode, spon_encode_bitmap, spon_reply_key)
 
 log = logging.getLogger(__name__)
 
 
+class SponProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, master):
+        self.master = master
+
+    def connection_made(self, transport):
+        self.master.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.master.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        log.error('Socket exception: {}'.format(exc))
+
+    def connection_lost(self, exc):
+        log.error('The server endpoint closed: {}'.format(exc))
+        self.master.transport = None
+        self.master.opening = None
+
+
+class TerminalSet(object):
+    """Set of terminal ids 1..size kept as the 0xC3 broadcast bitmap.
+
+    Terminal d is bit (d - 1) % 8 of byte (d - 1) // 8, so the bitmap
+    is copied into a frame as is. Ids outside 1..size raise ValueError.
+    """
+
+    __slots__ = ('size', 'bits')
+
+    def __init__(self, ids=(), size=1000):
+        self.size = size
+        nbytes = (size + 7) // 8
+        if not isinstance(ids, (list, tuple, range)):
+            ids = list(ids)
+        if not ids:
+            self.bits = bytearray(nbytes)
+            return
+        # one b'1' at index d per id, set in C by map(), read back as a
+        # base 2 int; ids of 0 or below land in flags[0] or past size
+        flags = bytearray(b'0') * (2 * size + 2)
+        try:
+            collections.deque(map(flags.__setitem__, ids,
+                                  itertools.repeat(0x31)), 0)
+        except IndexError:
+            flags[0] = 0x31
+        if flags[0] != 0x30 or flags.find(b'1', size + 1) >= 0:
+            for d in ids:
+                self._locate(d)
+        value = int(flags[size:0:-1], 2)
+        self.bits = bytearray(value.to_bytes(nbytes, 'little'))
+
+    def _locate(self, d):
+        if not 1 <= d <= self.size:
+            raise ValueError('Terminal id {} out of range 1-{}'.format(
+                d, self.size))
+        return (d - 1) >> 3, 1 << ((d - 1) & 7)
+
+    def add(self, d):
+        i, mask = self._locate(d)
+        self.bits[i] |= mask
+
+    def discard(self, d):
+        i, mask = self._locate(d)
+        self.bits[i] &= ~mask & 0xFF
+
+    def __contains__(self, d):
+        if not 1 <= d <= self.size:
+            return False
+        return bool(self.bits[(d - 1) >> 3] & (1 << ((d - 1) & 7)))
+
+    def __iter__(self):
+        for i, byte in enumerate(self.bits):
+            while byte:
+                low = byte & -byte
+                yield i * 8 + low.bit_length()
+                byte ^= low
+
+    def __len__(self):
+        return bin(self.to_int()).count('1')
+
+    def __bool__(self):
+        return any(self.bits)
+
+    def __eq__(self, other):
+        if not isinstance(other, TerminalSet):
+            return NotImplemented
+        return self.to_int() == other.to_int()
+
+    def __repr__(self):
+        return 'TerminalSet({})'.format(list(self))
+
+    def to_int(self):
+        return int.from_bytes(self.bits, 'little')
+
+    def max(self):
+        """Highest terminal id in the set, 0 when empty."""
+        return self.to_int().bit_length()
+
+    def _combine(self, other, value):
+        size = max(self.size, other.size)
+        result = TerminalSet(size=size)
+        result.bits[:] = value.to_bytes(len(result.bits), 'little')
+        return result
+
+    def __or__(self, other):
+        return self._combine(other, self.to_int() | other.to_int())
+
+    def __and__(self, other):
+        return self._combine(other, self.to_int() & other.to_int())
+
+    def __sub__(self, other):
+        return self._combine(other, self.to_int() & ~other.to_int())
+
+    def delta(self, desired):
+        """Return (to_start, to_stop) turning this set into desired."""
+        return desired - self, self - desired
+
+    def pack_into(self, buf, offset, nbytes):
+        """Copy the first nbytes of the bitmap into buf at offset."""
+        if any(self.bits[nbytes:]):
+            raise ValueError('Terminal id {} does not fit in {} bytes'.format(
+                self.max(), nbytes))
+        data = self.bits[:nbytes]
+        buf[offset:offset + len(data)] = data
+        return offset + nbytes
+
+
 class Spon(object):
 
-    HEAD = b'\xFF\xFF'
+    HEAD = SPON_HEAD
     ACTION = {
         'CALL': 0x00,
         'ANSWER': 0x01,
@@ -23,46 +155,171 @@ class Spon(object):
         'START_SINGLE': 0x05
     }
 
-    def __init__(self, host, port, local_term=1, broadcast_term=1):
+    def __init__(self, loop, host, port, local_term=1, broadcast_term=1,
+                 timeout=0.1, retries=3, min_rto=0.05, max_rto=2.0,
+                 retry_budget=0.2):
+        self.loop = loop or asyncio.get_event_loop()
         self.server_address = (host, port)
         self.local_term = local_term
         self.broadcast_term = broadcast_term
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setblocking(1)
-        self.sock.settimeout(0.1)
-        self.send_str = b''
+        self.transport = None
+        self.opening = None
+        # (opcode, terminal fields) -> futures waiting for a reply
+        self.pending = {}
+        # retransmit timeout from smoothed round trips, RFC 6298 style;
+        # timeout is the first guess until a reply was timed
+        self.rto = timeout
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.retries = retries
+        # each request adds retry_budget retransmits, up to 10 banked,
+        # so a dead server is not flooded with retries
+        self.retry_budget = retry_budget
+        self.retry_tokens = 10.0
+        self.requests = 0
+        self.replies = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        self.budget_exhausted = 0
+        self.unsolicited = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    async def open(self):
+        if self.transport is not None:
+            return self.transport
+        if self.opening is None:
+            self.opening = self.loop.create_task(
+                self.loop.create_datagram_endpoint(
+                    lambda: SponProtocol(self),
+                    remote_addr=self.server_address))
+        try:
+            await asyncio.shield(self.opening)
+        except Exception:
+            self.opening = None
+            raise
         log.info('Connect to server {}: {}'.format(self.server_address,
-                                                   self.sock))
+                                                   self.transport))
+        return self.transport
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        for waiters in self.pending.values():
+            for fut in waiters:
+                fut.cancel()
+        self.pending.clear()
+
+    def get_info(self):
+        replies = self.replies
+        return {
+            'server': '{}:{}'.format(*self.server_address),
+            'requests': self.requests,
+            'replies': replies,
+            'retransmits': self.retransmits,
+            'timeouts': self.timeouts,
+            'budget_exhausted': self.budget_exhausted,
+            'unsolicited': self.unsolicited,
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'rto': self.rto,
+            'latency_avg': self.latency_total / replies if replies else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+    def datagram_received(self, data, addr):
+        log.debug('Received from {}: {}'.format(addr, data))
+        if len(data) < 3:
+            log.warning('Short datagram from {}: {}'.format(addr, data))
+            return
+        waiters = self.pending.get(spon_reply_key(data))
+        while waiters:
+            fut = waiters.popleft()
+            if not fut.done():
+                fut.set_result(data)
+                return
+        self.unsolicited += 1
+        log.debug('Unsolicited datagram from {}: {}'.format(addr, data))
+
+    def _sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto),
+                       self.max_rto)
 
-    def sends(self):
-        return self.send_to_server(self.send_str)
+    async def send_to_server(self, message):
+        """Send message until its reply arrives, return None if none did.
 
-    def send_to_server(self, message):
-        # send data
+        The request is sent again after each retransmit timeout, up to
+        retries times while the retry budget lasts.
+        """
         data = None
+        waiters = self.pending.setdefault(spon_reply_key(message),
+                                          collections.deque())
+        fut = self.loop.create_future()
+        waiters.append(fut)
+        self.requests += 1
+        self.retry_tokens = min(self.retry_tokens + self.retry_budget, 10.0)
+        start = self.loop.time()
         try:
-            log.debug('Send to {}: {}'.format(self.server_address, message))
-            self.sock.sendto(message, self.server_address)
-            data, address = self.sock.recvfrom(1024)
-            log.debug('Received from {}: {}'.format(address, data))
-        except socket.error as e:
+            transport = await self.open()
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    if self.retry_tokens < 1:
+                        self.budget_exhausted += 1
+                        break
+                    self.retry_tokens -= 1
+                    self.retransmits += 1
+                sent = self.loop.time()
+                log.debug('Send to {}: {}'.format(self.server_address,
+                                                  bytes(message)))
+                transport.sendto(message)
+                try:
+                    data = await asyncio.wait_for(asyncio.shield(fut),
+                                                  self.rto)
+                except asyncio.TimeoutError:
+                    self.rto = min(self.rto * 2, self.max_rto)
+                    continue
+                now = self.loop.time()
+                if not attempt:
+                    # Karn: a retransmitted request gives no clean sample
+                    self._sample_rtt(now - sent)
+                self.replies += 1
+                self.latency_total += now - start
+                self.latency_max = max(self.latency_max, now - start)
+                break
+            if data is None:
+                self.timeouts += 1
+                log.error('No reply from {} after {} tries'.format(
+                    self.server_address, attempt + 1))
+        except OSError as e:
             log.error('Socket exception: {}'.format(e))
-        except Exception as e:
-            log.error('Other exception: {}'.format(e))
         finally:
-            return data
+            if not fut.done():
+                fut.cancel()
+            if fut in waiters:
+                waiters.remove(fut)
+        return data
 
     def terminal_control(self, action, dest, src_term=None):
         src = src_term or self.local_term
         act = self.ACTION.get(action.upper())
         if act is None:
             return None
-        self.send_str = self.HEAD + b'\xC1'
-        s = struct.Struct('<BHH')
-        values = (act, src, dest)
-        self.send_str += s.pack(*values)
+        frame = spon_encode(SPON_TERMINAL_CONTROL, act, src, dest)
         log.info('{} [0xC1]terminal_control({},{})'.format(action, dest, src))
-        return self.sends()
+        return self.send_to_server(frame)
+
+    def _bitmap_frame(self, act, src, dests, nbytes):
+        if not isinstance(dests, TerminalSet):
+            dests = TerminalSet(dests, nbytes * 8)
+        return spon_encode_bitmap(act, src, dests, nbytes)
 
     def broadcast_control(self, action, dests, src_term=None):
         src = src_term or self.broadcast_term
@@ -70,26 +327,11 @@ class Spon(object):
             act = 0x00
         else:
             act = 0x01
-        self.send_str = self.HEAD + b'\xC3'
-        s = struct.Struct('<BHH')
-        values = (act, src, 0x00)
-        self.send_str += s.pack(*values)
-        bits = []
-        for i in range(16):
-            bits.append(0x00)
-        for d in dests:
-            if (d > 128) or (d < 1):
-                continue
-            x = (d - 1) // 8
-            y = (d - 1) - (x * 8)
-            bits[x] |= (1 << y)
-        p = struct.Struct('B')
-        for i in range(16):
-            self.send_str += p.pack(bits[i])
+        frame = self._bitmap_frame(act, src, dests, SPON_CONTROL_BYTES)
         log.info('{} broadcast[0xC3]_control({},{})'.format(action,
                                                             dests,
                                                             src))
-        return self.sends()
+        return self.send_to_server(frame)
 
     def broadcast_extend(self, action, dests, src_term=None):
         src = src_term or self.broadcast_term
@@ -97,48 +339,96 @@ class Spon(object):
             act = 0x02
         else:
             act = 0x03
-        self.send_str = self.HEAD + b'\xC3'
-        s = struct.Struct('<BHH')
-        values = (act, src, 0x00)
-        self.send_str += s.pack(*values)
-        bits = []
-        for i in range(125):
-            bits.append(0x00)
-        for d in dests:
-            if (d > 1000) or (d < 1):
-                continue
-            x = (d - 1) // 8
-            y = (d - 1) - (x * 8)
-            bits[x] |= (1 << y)
-        p = struct.Struct('B')
-        for i in range(125):
-            self.send_str += p.pack(bits[i])
+        frame = self._bitmap_frame(act, src, dests, SPON_EXTEND_BYTES)
         log.info('{} broadcast[0xC3]_extend({},{})'.format(action, dests, src))
-        return self.sends()
+        return self.send_to_server(frame)
 
     def broadcast_single(self, action, dest, zone=0):
         if action.upper() == 'STOP':
             act = 0x04
         else:
             act = 0x05
-        self.send_str = self.HEAD + b'\xC3'
-        s = struct.Struct('<BHH')
-        values = (act, dest, zone)
-        self.send_str += s.pack(*values)
+        frame = spon_encode(SPON_BROADCAST, act, dest, zone)
         log.info('{} broadcast[0xC3]_single({},{})'.format(action, dest, zone))
-        return self.sends()
+        return self.send_to_server(frame)
 
     def alarm_task(self, action, task, zone=0):
         if action.upper() == 'STOP':
             act = 0x00
         else:
             act = 0x01
-        self.send_str = self.HEAD + b'\xCA'
-        s = struct.Struct('<BHH')
-        values = (act, task, 0)
-        self.send_str += s.pack(*values)
+        frame = spon_encode(SPON_ALARM_TASK, act, task, 0)
         log.info('{} Alarm_Task[0xCA]({})'.format(action, task))
-        return self.sends()
+        return self.send_to_server(frame)
+
+
+class SponCluster(object):
+    """Spon servers that each own part of the terminals.
+
+    Terminals are routed by an explicit table first, then by id
+    ranges; anything else goes to the default server, if there is one.
+    """
+
+    def __init__(self, default=None):
+        self.servers = []
+        self.default = default
+        # terminal -> server
+        self.table = {}
+        # sorted (first, last, server) with parallel starts for bisect
+        self.ranges = []
+        self.starts = []
+        if default is not None:
+            self.servers.append(default)
+
+    def __len__(self):
+        return len(self.servers)
+
+    def add(self, server, ranges=(), terminals=()):
+        if server not in self.servers:
+            self.servers.append(server)
+        for first, last in ranges:
+            if first > last:
+                raise ValueError('Invalid terminal range {}-{}'.format(
+                    first, last))
+            i = bisect.bisect(self.starts, first)
+            if ((i and self.ranges[i - 1][1] >= first) or
+                    (i < len(self.starts) and self.starts[i] <= last)):
+                raise ValueError('Terminal range {}-{} overlaps'.format(
+                    first, last))
+            self.starts.insert(i, first)
+            self.ranges.insert(i, (first, last, server))
+        for d in terminals:
+            self.table[d] = server
+
+    def route(self, dest):
+        server = self.table.get(dest)
+        if server is not None:
+            return server
+        i = bisect.bisect(self.starts, dest)
+        if i:
+            first, last, server = self.ranges[i - 1]
+            if dest <= last:
+                return server
+        return self.default
+
+    def split(self, dests):
+        """Group dests by server, return ({server: [dest]}, unrouted)."""
+        groups = collections.OrderedDict()
+        unrouted = []
+        for d in dests:
+            server = self.route(d)
+            if server is None:
+                unrouted.append(d)
+            else:
+                groups.setdefault(server, []).append(d)
+        return groups, unrouted
+
+    def get_info(self):
+        return [server.get_info() for server in self.servers]
+
+    def close(self):
+        for server in self.servers:
+            server.close()
 
 
 if __name__ == '__main__':
@@ -158,30 +448,36 @@ if __name__ == '__main__':
     host = '192.168.1.169'
     port = 2048
 
-    spon = Spon(host, port)
-
-    message = b'\xff\xff\xc1\x00\x02\x00\x03\x00'
-    reps = spon.send_to_server(message)
-    log.info('Received: {}'.format(reps))
-
-    message = b'\xff\xff\xcc\x00\x00\x00\x00\x00'
-    reps = spon.send_to_server(message)
-    log.info('Received: {}'.format(reps))
-
-    message = b'\xff\xff\xc6\x00\x02\x00\x00\x00'
-    reps = spon.send_to_server(message)
-    log.info('Received: {}'.format(reps))
-
-    spon.terminal_control('call', 2, 3)
-    spon.terminal_control('answer', 4, 3)
-    spon.terminal_control('hangup', 4, 3)
-
-    spon.broadcast_control('start', [3, 4, 5, 16,
-                                     98, 128, 127, 26], 4)
-    spon.broadcast_control('stop', [3, 4], 2)
-    spon.broadcast_extend('start', [3, 4, 5, 16,
-                                    98, 128, 200, 256,
-                                    345, 998, 1000], 3)
-    spon.broadcast_extend('stop', [3], 4)
-    spon.broadcast_single('start', 4, 3)
-    print(spon.broadcast_single('stop', 4, 3))
+    loop = asyncio.get_event_loop()
+    spon = Spon(loop, host, port)
+
+    async def main():
+        message = b'\xff\xff\xc1\x00\x02\x00\x03\x00'
+        reps = await spon.send_to_server(message)
+        log.info('Received: {}'.format(reps))
+
+        message = b'\xff\xff\xcc\x00\x00\x00\x00\x00'
+        reps = await spon.send_to_server(message)
+        log.info('Received: {}'.format(reps))
+
+        message = b'\xff\xff\xc6\x00\x02\x00\x00\x00'
+        reps = await spon.send_to_server(message)
+        log.info('Received: {}'.format(reps))
+
+        await spon.terminal_control('call', 2, 3)
+        await spon.terminal_control('answer', 4, 3)
+        await spon.terminal_control('hangup', 4, 3)
+
+        await spon.broadcast_control('start', [3, 4, 5, 16,
+                                               98, 128, 127, 26], 4)
+        await spon.broadcast_control('stop', [3, 4], 2)
+        await spon.broadcast_extend('start', [3, 4, 5, 16,
+                                              98, 128, 200, 256,
+                                              345, 998, 1000], 3)
+        await spon.broadcast_extend('stop', [3], 4)
+        await spon.broadcast_single('start', 4, 3)
+        print(await spon.broadcast_single('stop', 4, 3))
+
+    loop.run_until_complete(main())
+    spon.close()
+    loop.close()
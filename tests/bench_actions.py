@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""Memory used by the action table for 10k registered devices.
+
+Compares the previous dict-per-action layout with ActionState records:
+
+    python -m tests.bench_actions
+"""
+
+import time
+import tracemalloc
+
+from speaker.actions import ActionState, format_time
+
+DEVICES = 10000
+
+
+def dict_table():
+    actions = {}
+    for i in range(DEVICES):
+        actions['SPK_{}'.format(i)] = {
+            'status': 'AUTO',
+            'timeout': 20,
+            'timestamp': format_time()
+        }
+    return actions
+
+
+def slot_table():
+    actions = {}
+    now = time.time()
+    for i in range(DEVICES):
+        actions['SPK_{}'.format(i)] = ActionState('AUTO', 20, now, now + 20)
+    return actions
+
+
+def measure(build):
+    tracemalloc.start()
+    table = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return table, size
+
+
+if __name__ == '__main__':
+    for name, build in (('dict', dict_table), ('ActionState', slot_table)):
+        table, size = measure(build)
+        print('{:12s} {:8.1f} KiB per {} devices, {:5.1f} B/device'.format(
+            name, size / 1024.0, len(table), size / float(len(table))))
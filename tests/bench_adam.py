@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""Frames on the wire for an alarm burst on an Adam-6000 module.
+
+Drives a local Modbus TCP responder with one FC 5 write per zone and
+with the coalesced FC 0x0F bank writes of Adam.alarm_task:
+
+    python -m tests.bench_adam
+"""
+
+import asyncio
+import struct
+import time
+
+from speaker.adam import Adam, MbapDecoder
+
+ROUNDS = 500
+ZONES = 8
+
+
+class Responder(asyncio.Protocol):
+    frames = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.decoder = MbapDecoder()
+
+    def data_received(self, data):
+        for tid, unit, pdu in self.decoder.feed(data):
+            Responder.frames += 1
+            reply = pdu if pdu[0] == 5 else pdu[:5]
+            self.transport.write(struct.pack('>HHHB', tid, 0,
+                                             len(reply) + 1, unit) + reply)
+
+
+async def single_coils(adam):
+    for i in range(ROUNDS):
+        action = 'ON' if i % 2 else 'OFF'
+        await asyncio.gather(*[adam.force_single_coil(0x10 + zone, action)
+                               for zone in range(ZONES)])
+
+
+async def coalesced(adam):
+    for i in range(ROUNDS):
+        action = 'ON' if i % 2 else 'OFF'
+        await asyncio.gather(*[adam.alarm_task(action, 0, zone)
+                               for zone in range(ZONES)])
+
+
+async def main(loop):
+    server = await loop.create_server(Responder, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    for name, run in (('FC 0x05 per zone', single_coils),
+                      ('FC 0x0F coalesced', coalesced)):
+        adam = Adam(loop, '127.0.0.1', port, poll_interval=0)
+        await adam.conn.wait_connected()
+        await asyncio.sleep(0.1)
+        adam.shadow = None
+        Responder.frames = 0
+        start = time.perf_counter()
+        await run(adam)
+        elapsed = time.perf_counter() - start
+        print('{:18s} {:6d} frames {:8.3f}s {:9.0f} zone changes/s'.format(
+            name, Responder.frames, elapsed, ROUNDS * ZONES / elapsed))
+        adam.conn.close()
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop))
+    loop.close()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""Encode throughput of the speaker.codec frame builders.
+
+Each protocol is timed with the former build (new Struct per call and
+bytes concatenation), with a fresh buffer per frame and with one
+reused caller buffer:
+
+    python -m tests.bench_codec
+"""
+
+import struct
+import timeit
+
+from speaker import codec
+from speaker.spon import TerminalSet
+
+ROUNDS = 100000
+
+
+def legacy_spon(act, task):
+    send_str = b'\xFF\xFF' + b'\xCA'
+    s = struct.Struct('<BHH')
+    send_str += s.pack(act, task, 0)
+    return send_str
+
+
+def legacy_mbap(tid, address, value):
+    cmd = struct.Struct('>HHH').pack(tid, 0, 6)
+    cmd += struct.Struct('>BBHH').pack(1, 5, address, value)
+    return cmd
+
+
+def legacy_oip(zones, priority, message, reference):
+    return codec.oip_frame(codec.OIP_START_CALL, b''.join((
+        codec.OIP_START_CALL_HEAD.pack(priority),
+        codec.oip_string(','.join(zones)),
+        codec.oip_string(''),
+        codec.oip_string(''),
+        codec.oip_string(''),
+        codec.oip_string(message))), reference)
+
+
+def main():
+    buf = bytearray(256)
+    terms = TerminalSet(range(1, 1001, 3))
+    zones = ['Zone{}'.format(i) for i in range(8)]
+    cases = (
+        ('spon 0xCA legacy', lambda: legacy_spon(1, 7)),
+        ('spon 0xCA fresh', lambda: codec.spon_encode(
+            codec.SPON_ALARM_TASK, 1, 7, 0)),
+        ('spon 0xCA reused', lambda: codec.spon_encode(
+            codec.SPON_ALARM_TASK, 1, 7, 0, buf)),
+        ('spon 0xC3 extend reused', lambda: codec.spon_encode_bitmap(
+            3, 1, terms, codec.SPON_EXTEND_BYTES, buf)),
+        ('mbap fc5 legacy', lambda: legacy_mbap(1, 0x10, 0xFF00)),
+        ('mbap fc5 fresh', lambda: codec.mbap_write_coil(
+            1, 1, 0x10, 0xFF00)),
+        ('mbap fc5 reused', lambda: codec.mbap_write_coil(
+            1, 1, 0x10, 0xFF00, buf)),
+        ('mbap fc15 reused', lambda: codec.mbap_write_coils(
+            1, 1, 0x10, 8, 0xA5, buf)),
+        ('oip start call legacy', lambda: legacy_oip(
+            zones, 80, 'xiaofang', 1)),
+        ('oip start call fresh', lambda: codec.oip_start_call(
+            zones, 80, 'xiaofang', 1)),
+        ('oip start call reused', lambda: codec.oip_start_call(
+            zones, 80, 'xiaofang', 1, buf)),
+    )
+    for name, func in cases:
+        elapsed = timeit.timeit(func, number=ROUNDS)
+        print('{:24s} {:10.0f} frames/s'.format(name, ROUNDS / elapsed))
+
+
+if __name__ == '__main__':
+    main()
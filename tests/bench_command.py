@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""Messages/sec through decode and validation of action messages.
+
+The stdlib json decode is timed against Command.decode with the
+installed JSON backend, for a single device and a 200 device list,
+parsing each name or resolving it through a DeviceRegistry:
+
+    python -m tests.bench_command
+"""
+
+import json
+import timeit
+
+from speaker.command import Command, JSON_BACKEND
+from speaker.registry import DeviceRegistry
+
+ROUNDS = 20000
+
+
+def main():
+    single = json.dumps({'name': 'SPK_12_3', 'status': 'auto',
+                         'priority': 'routine'}).encode()
+    group = json.dumps({'name': ['SPK_{}'.format(i) for i in range(1, 201)],
+                        'status': 'ON'}).encode()
+    registry = DeviceRegistry()
+    registry.configure({'groups': {'FLOOR_3': ['SPK_1-200']}})
+    floor = json.dumps({'name': 'FLOOR_3', 'status': 'ON'}).encode()
+    print('JSON backend: {}'.format(JSON_BACKEND))
+    cases = (
+        ('single json.loads', lambda: json.loads(single)),
+        ('single Command.decode', lambda: Command.decode(single)),
+        ('200 names json.loads', lambda: json.loads(group)),
+        ('200 names Command.decode', lambda: Command.decode(group)),
+        ('200 names registry', lambda: registry.decode(group)),
+        ('group registry', lambda: registry.decode(floor)),
+    )
+    for name, func in cases:
+        rounds = ROUNDS if '200' not in name else ROUNDS // 20
+        elapsed = timeit.timeit(func, number=rounds)
+        print('{:26s} {:10.0f} messages/s'.format(name, rounds / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8 _*_
+
+"""Build time of 1000-terminal Spon broadcast frames.
+
+Compares the former list-and-struct bitmap builder with TerminalSet
+copied into a preallocated frame, and a delta update between two
+active sets:
+
+    python -m tests.bench_spon
+"""
+
+import random
+import struct
+import timeit
+
+from speaker.spon import Spon, TerminalSet
+
+ROUNDS = 2000
+TERMINALS = 1000
+
+
+def legacy_extend(dests):
+    send_str = Spon.HEAD + b'\xC3'
+    send_str += struct.Struct('<BHH').pack(0x03, 1, 0x00)
+    bits = []
+    for i in range(125):
+        bits.append(0x00)
+    for d in dests:
+        if (d > 1000) or (d < 1):
+            continue
+        x = (d - 1) // 8
+        y = (d - 1) - (x * 8)
+        bits[x] |= (1 << y)
+    p = struct.Struct('B')
+    for i in range(125):
+        send_str += p.pack(bits[i])
+    return send_str
+
+
+def main():
+    spon = Spon(None, '127.0.0.1', 2048)
+    dests = random.sample(range(1, TERMINALS + 1), TERMINALS // 2)
+    terms = TerminalSet(dests)
+    active = TerminalSet(random.sample(range(1, TERMINALS + 1),
+                                       TERMINALS // 2))
+    assert legacy_extend(dests) == spon._bitmap_frame(0x03, 1, terms, 125)
+
+    cases = (
+        ('list + struct per byte', lambda: legacy_extend(dests)),
+        ('TerminalSet from ids', lambda: spon._bitmap_frame(
+            0x03, 1, dests, 125)),
+        ('TerminalSet prebuilt', lambda: spon._bitmap_frame(
+            0x03, 1, terms, 125)),
+        ('delta to active set', lambda: active.delta(terms)),
+    )
+    for name, func in cases:
+        elapsed = timeit.timeit(func, number=ROUNDS)
+        print('{:24s} {:8.2f} us/frame'.format(name,
+                                               elapsed / ROUNDS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
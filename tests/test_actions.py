@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.actions` module."""
+
+
+import unittest
+
+from speaker.actions import ActionState, ActionTable
+
+
+class TestActionTable(unittest.TestCase):
+    """Tests for `speaker.actions.ActionTable`."""
+
+    def test_capacity_evicts_least_recent(self):
+        table = ActionTable(capacity=3, ttl=60)
+        for i in range(5):
+            table['SPK_{}'.format(i)] = ActionState('ON', changed=100 + i)
+        table['SPK_2'] = ActionState('OFF', changed=110)
+        table['SPK_5'] = ActionState('ON', changed=111)
+        self.assertEqual(list(table.table), ['SPK_3', 'SPK_4', 'SPK_5'])
+        self.assertEqual(table.get_info()['evicted'], 3)
+        self.assertIsNone(table.get('SPK_0'))
+
+    def test_capacity_keeps_playing_entries(self):
+        table = ActionTable(capacity=3, ttl=60)
+        table['SPK_1'] = ActionState('AUTO', changed=100)
+        table['SPK_2'] = ActionState('OFF', changed=101)
+        table['SPK_3'] = ActionState('ON', changed=102)
+        table['SPK_4'] = ActionState('Off/Stop', changed=103)
+        self.assertEqual(list(table.table), ['SPK_1', 'SPK_3', 'SPK_4'])
+        table['SPK_5'] = ActionState('ON', changed=104)
+        self.assertEqual(list(table.table), ['SPK_1', 'SPK_3', 'SPK_5'])
+        table['SPK_6'] = ActionState('ON', changed=105)
+        self.assertEqual(list(table.table), ['SPK_3', 'SPK_5', 'SPK_6'])
+        self.assertEqual(table.get_info()['evicted'], 3)
+
+    def test_ttl_drops_only_inactive(self):
+        table = ActionTable(ttl=60)
+        table['SPK_1'] = ActionState('Off/Stop', changed=100)
+        table['SPK_2'] = ActionState('ON', changed=100)
+        table['SPK_3'] = ActionState('OFF', changed=130)
+        table['SPK_4'] = ActionState('OFF', changed=170)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.expire(200), 1)
+        self.assertEqual(list(table.table), ['SPK_2', 'SPK_4'])
+        self.assertEqual(table.get_info()['expired'], 2)
+        table['SPK_5'] = ActionState('ON', changed=400)
+        self.assertEqual(list(table.table), ['SPK_2', 'SPK_5'])
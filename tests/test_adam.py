@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.adam` module."""
+
+
+import asyncio
+import struct
+import unittest
+
+from speaker.adam import Adam, MbapDecoder
+
+
+class ModbusServerProtocol(asyncio.Protocol):
+    """Answers FC 1, 5 and 15 like an Adam-6000 module."""
+
+    def __init__(self, server):
+        self.server = server
+        self.decoder = MbapDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.clients.append(transport)
+
+    def data_received(self, data):
+        for tid, unit, pdu in self.decoder.feed(data):
+            self.server.requests.append(pdu)
+            if self.server.silent:
+                continue
+            fc = pdu[0]
+            if fc == 1:
+                count = struct.unpack('>H', pdu[3:5])[0]
+                bank = self.server.coils.to_bytes((count + 7) // 8, 'little')
+                reply = bytes([fc, len(bank)]) + bank
+            elif fc == 5:
+                addr, value = struct.unpack('>HH', pdu[1:5])
+                bit = 1 << (addr - 0x10)
+                if value == 0xFF00:
+                    self.server.coils |= bit
+                else:
+                    self.server.coils &= ~bit
+                reply = pdu
+            elif fc == 15:
+                self.server.coils = int.from_bytes(pdu[6:6 + pdu[5]],
+                                                   'little')
+                reply = pdu[:5]
+            else:
+                reply = bytes([fc | 0x80, 1])
+            self.transport.write(struct.pack('>HHHB', tid, 0,
+                                             len(reply) + 1, unit) + reply)
+
+
+class ModbusServer(object):
+    def __init__(self):
+        self.clients = []
+        self.requests = []
+        self.coils = 0
+        self.silent = False
+
+
+class TestMbapDecoder(unittest.TestCase):
+    """Tests for `speaker.adam.MbapDecoder`."""
+
+    FRAME_1 = b'\x00\x01\x00\x00\x00\x06\x01\x05\x00\x10\xff\x00'
+    FRAME_2 = b'\x00\x02\x00\x00\x00\x04\x01\x01\x01\x03'
+
+    def test_partial_segments(self):
+        decoder = MbapDecoder()
+        data = self.FRAME_1 + self.FRAME_2
+        frames = []
+        for i in range(len(data)):
+            frames.extend(decoder.feed(data[i:i + 1]))
+        self.assertEqual(frames, [(1, 1, b'\x05\x00\x10\xff\x00'),
+                                  (2, 1, b'\x01\x01\x03')])
+        self.assertEqual(len(decoder.buffer), 0)
+
+    def test_coalesced_segments(self):
+        decoder = MbapDecoder()
+        frames = decoder.feed(self.FRAME_1 + self.FRAME_2 + self.FRAME_1[:3])
+        self.assertEqual([tid for tid, _, _ in frames], [1, 2])
+        self.assertEqual(bytes(decoder.buffer), self.FRAME_1[:3])
+
+    def test_invalid_header(self):
+        decoder = MbapDecoder()
+        with self.assertRaises(ValueError):
+            decoder.feed(b'\x00\x01\x00\x07\x00\x06\x01\x05')
+        self.assertEqual(len(decoder.buffer), 0)
+
+
+class TestAdam(unittest.TestCase):
+    """Tests for `speaker.adam.Adam`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.modbus = ModbusServer()
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: ModbusServerProtocol(self.modbus), '127.0.0.1', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.adam = Adam(self.loop, '127.0.0.1', port,
+                         request_timeout=0.2, poll_interval=0)
+        self.loop.run_until_complete(self._connect())
+
+    async def _connect(self):
+        await self.adam.conn.wait_connected(1)
+        # let the initial coil read finish
+        await asyncio.sleep(0.02)
+        del self.modbus.requests[:]
+        self.adam.shadow = None
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.adam.conn.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def test_read_coils_status(self):
+        self.modbus.coils = 0x05
+        coils = self.loop.run_until_complete(self.adam.read_coils_status())
+        self.assertEqual(coils, 0x05)
+
+    def test_pipelined_writes_are_acknowledged(self):
+        async def burst():
+            return await asyncio.gather(
+                *[self.adam.force_single_coil(0x10 + coil, 'ON')
+                  for coil in range(8)])
+
+        acks = self.loop.run_until_complete(burst())
+        self.assertEqual(acks, [True] * 8)
+        self.assertEqual(self.modbus.coils, 0xFF)
+        self.assertFalse(self.adam.pending)
+
+    def test_zone_changes_coalesce_into_one_frame(self):
+        self.adam.coil_count = 12
+
+        async def burst():
+            return await asyncio.gather(
+                self.adam.alarm_task('ON', 0, 1),
+                self.adam.alarm_task('ON', 0, 11),
+                self.adam.alarm_task('OFF', 0, 1),
+                self.adam.alarm_task('ON', 0, 12))
+
+        acks = self.loop.run_until_complete(burst())
+        self.assertEqual(acks, [True, True, True, False])
+        self.assertEqual(self.modbus.requests,
+                         [b'\x0f\x00\x10\x00\x0c\x02\x00\x08'])
+        self.assertEqual(self.modbus.coils, 1 << 11)
+
+    def test_request_timeout(self):
+        self.modbus.silent = True
+        ack = self.loop.run_until_complete(asyncio.wait_for(
+            self.adam.alarm_task('ON', 0, 1), 1))
+        self.assertFalse(ack)
+        self.assertFalse(self.adam.pending)
+
+    def test_redundant_writes_are_suppressed(self):
+        run = self.loop.run_until_complete
+        self.assertTrue(run(self.adam.alarm_task('ON', 0, 1)))
+        self.assertTrue(run(self.adam.alarm_task('ON', 0, 1)))
+        self.assertEqual(len(self.modbus.requests), 1)
+        self.assertEqual(self.adam.writes_suppressed, 1)
+        self.assertEqual(self.adam.shadow, 0x02)
+
+    def test_poll_publishes_diffs_and_reconciles(self):
+        changes = []
+        self.adam.on_change = changes.append
+        self.adam.shadow = 0
+        self.adam.poll_interval = 0.02
+        self.modbus.coils = 0x05
+        task = self.loop.create_task(self.adam._poll_coils())
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        task.cancel()
+        self.assertEqual(changes[0], [(0, True), (2, True)])
+        self.assertEqual(changes[1], [(0, False), (2, False)])
+        self.assertEqual(self.modbus.coils, 0)
+
+
+class TestAdamOffline(unittest.TestCase):
+    """Coil writes made while the module is unreachable."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.modbus = ModbusServer()
+        server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: ModbusServerProtocol(self.modbus), '127.0.0.1', 0))
+        self.port = server.sockets[0].getsockname()[1]
+        server.close()
+        self.loop.run_until_complete(server.wait_closed())
+        self.adam = Adam(self.loop, '127.0.0.1', self.port,
+                         poll_interval=0)
+        self.adam.conn.backoff = 0.02
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.adam.conn.close()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def test_buffered_writes_replay_on_connect(self):
+        async def alarm():
+            return await asyncio.gather(self.adam.alarm_task('ON', 0, 1),
+                                        self.adam.alarm_task('ON', 0, 3))
+
+        task = self.loop.create_task(alarm())
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertFalse(task.done())
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: ModbusServerProtocol(self.modbus), '127.0.0.1',
+            self.port))
+        acks = self.loop.run_until_complete(asyncio.wait_for(task, 2))
+        self.assertEqual(acks, [True, True])
+        self.assertEqual(self.modbus.coils, 0x0A)
+        self.assertEqual(self.adam.buffer.get_info()['flushed'], 1)
+
+    def test_caller_stops_waiting_for_buffered_write(self):
+        self.adam.buffer_timeout = 0.05
+        ack = self.loop.run_until_complete(asyncio.wait_for(
+            self.adam.alarm_task('ON', 0, 1), 1))
+        self.assertFalse(ack)
+        ack = self.loop.run_until_complete(asyncio.wait_for(
+            self.adam.alarm_task('ON', 0, 3), 1))
+        self.assertFalse(ack)
+        self.assertEqual(len(self.adam.buffer), 1)
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: ModbusServerProtocol(self.modbus), '127.0.0.1',
+            self.port))
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertEqual(self.modbus.coils, 0x0A)
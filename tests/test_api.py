@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.api` module."""
+
+
+import asyncio
+import gzip
+import json
+import unittest
+
+from aiohttp.test_utils import make_mocked_request
+
+from speaker.api import Api, Snapshot
+from speaker.speaker import SpeakerV1
+
+
+class TestSystemSnapshot(unittest.TestCase):
+    """Tests for the cached /v2/system response."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.site = SpeakerV1(self.loop)
+        self.api = Api(self.loop, site=self.site, refresh=60)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.loop.close()
+
+    def get(self, **headers):
+        request = make_mocked_request('GET', '/v2/system', headers=headers)
+        return self.loop.run_until_complete(self.api.handle_system(request))
+
+    def test_etag_and_304(self):
+        first = self.get()
+        self.assertEqual(first.status, 200)
+        etag = first.headers['ETag']
+        self.assertEqual(self.get(**{'If-None-Match': etag}).status, 304)
+        self.assertEqual(self.get(**{
+            'If-Modified-Since': first.headers['Last-Modified']}).status, 304)
+        self.assertEqual(self.api.builds, 1)
+
+        self.site._register('SPK_1', 'ON', 0)
+        changed = self.get(**{'If-None-Match': etag})
+        self.assertEqual(changed.status, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+        self.assertIn('SPK_1', json.loads(changed.body)['system']['actions'])
+        self.assertEqual(self.api.builds, 2)
+
+    def test_change_within_a_second(self):
+        first = Snapshot(b'{}', 100)
+        changed = Snapshot(b'{"SPK_1": "ON"}', 100, first)
+        later = Snapshot(b'{"SPK_1": "OFF"}', 101, changed)
+        self.assertEqual(changed.last_modified, first.last_modified)
+
+        def since(snapshot):
+            return make_mocked_request('GET', '/v2/system', headers={
+                'If-Modified-Since': snapshot.last_modified})
+
+        self.assertTrue(first.matches(since(first)))
+        self.assertFalse(changed.matches(since(first)))
+        self.assertFalse(changed.matches(since(changed)))
+        self.assertTrue(changed.matches(make_mocked_request(
+            'GET', '/v2/system', headers={'If-None-Match': changed.etag})))
+        self.assertTrue(later.matches(since(later)))
+
+    def test_gzip(self):
+        plain = self.get()
+        packed = self.get(**{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(packed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(packed.body), plain.body)
+        self.assertNotEqual(packed.headers['ETag'], plain.headers['ETag'])
+        self.assertEqual(self.get(**{
+            'If-None-Match': packed.headers['ETag']}).status, 304)
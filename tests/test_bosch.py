@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.bosch` module."""
+
+
+import asyncio
+import unittest
+
+from speaker import bosch, codec
+from speaker.speaker_bosch import Speaker_Bosch
+
+
+class TestOipCodec(unittest.TestCase):
+    """Tests for the OIP frame builders and decoder."""
+
+    # frames captured from the Praesideo controller
+    LOGIN = (b'\x02\x70\x44\x00\x22\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+             b'\x00\x00\x05\x00\x00\x00admin\x05\x00\x00\x00admin')
+    START_CALL = (b'\x03\x70\x44\x00\x39\x00\x00\x00\x00\x00\x00\x00\x00'
+                  b'\x00\x00\x00\x50\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+                  b'\x03\x00\x00\x00ALL\x00\x00\x00\x00\x00\x00\x00\x00'
+                  b'\x00\x00\x00\x00\x08\x00\x00\x00xiaofang')
+    KEEP_ALIVE = (b'\x27\x70\x44\x00\x10\x00\x00\x00\x00\x00\x00\x00\x00'
+                  b'\x00\x00\x00')
+
+    def test_golden_frames(self):
+        self.assertEqual(codec.oip_login('admin', 'admin'), self.LOGIN)
+        self.assertEqual(codec.oip_start_call(['ALL'], 80, 'xiaofang'),
+                         self.START_CALL)
+        self.assertEqual(codec.oip_keep_alive(), self.KEEP_ALIVE)
+
+    def test_start_call_zones_and_reference(self):
+        frame = codec.oip_start_call(['Zone1', 'Zone2'], 32, 'fire', 7)
+        msg_type, length, _, reference = codec.OIP_HEADER.unpack_from(frame)
+        self.assertEqual(msg_type, codec.OIP_START_CALL)
+        self.assertEqual(length, len(frame))
+        self.assertEqual(reference, 7)
+        self.assertIn(b'\x0b\x00\x00\x00Zone1,Zone2', frame)
+        self.assertEqual(frame[16:20], b'\x20\x00\x00\x00')
+
+    def test_decoder_partial_and_coalesced(self):
+        decoder = codec.OipDecoder()
+        body = b'\x00\x00\x00\x00\x2a\x00\x00\x00'
+        reply = codec.oip_frame(0x00447001, body, 5)
+        data = reply + codec.oip_keep_alive() + reply[:3]
+        frames = []
+        for i in range(0, len(data), 5):
+            frames.extend(decoder.feed(data[i:i + 5]))
+        self.assertEqual(frames, [
+            (0x00447001, 5, body),
+            (codec.OIP_KEEP_ALIVE, 0, b'')])
+        self.assertEqual(bytes(decoder.buffer), reply[:3])
+
+    def test_decoder_invalid_length(self):
+        decoder = codec.OipDecoder()
+        with self.assertRaises(ValueError):
+            decoder.feed(b'\x27\x70\x44\x00\x04\x00\x00\x00' + b'\x00' * 8)
+
+
+class OipServerProtocol(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.decoder = codec.OipDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.transport = transport
+
+    def data_received(self, data):
+        for msg_type, reference, body in self.decoder.feed(data):
+            self.server.received.append(msg_type)
+            if self.server.answer:
+                self.transport.write(codec.oip_frame(0x00447001,
+                                                     b'\x00' * 8,
+                                                     reference))
+
+    def connection_lost(self, exc):
+        self.server.closed = True
+
+
+class OipServer(object):
+    def __init__(self):
+        self.received = []
+        self.answer = True
+        self.closed = False
+        self.transport = None
+
+
+class TestKeepAlive(unittest.TestCase):
+    """Tests for the Bosch keepalive and liveness detection."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.oip = OipServer()
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: OipServerProtocol(self.oip), '127.0.0.1', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.bosch = bosch.Bosch(self.loop, '127.0.0.1', port,
+                                 keepalive_idle=0.02, keepalive_misses=2)
+        self.loop.run_until_complete(self.bosch.conn.wait_connected(1))
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.bosch.conn.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def test_keepalive_only_when_idle(self):
+        async def busy():
+            for _ in range(10):
+                self.bosch.call(codec.oip_stop_call(1))
+                await asyncio.sleep(0.005)
+
+        self.loop.run_until_complete(busy())
+        self.assertNotIn(codec.OIP_KEEP_ALIVE, self.oip.received)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertIn(codec.OIP_KEEP_ALIVE, self.oip.received)
+        self.assertIsNotNone(self.bosch.transport)
+
+    def test_missed_keepalives_drop_connection(self):
+        states = []
+        self.bosch.conn.add_listener(states.append)
+        self.oip.answer = False
+        self.loop.run_until_complete(asyncio.sleep(0.15))
+        self.assertEqual(states[0], 'disconnected')
+        self.assertTrue(self.oip.closed)
+
+    def test_request_timeouts_drop_connection(self):
+        async def busy():
+            for _ in range(2):
+                await self.bosch.startCall(['Zone1'])
+
+        states = []
+        self.bosch.conn.add_listener(states.append)
+        self.bosch.keepalive_idle = 10
+        self.bosch.timeout = 0.02
+        self.oip.answer = False
+        self.loop.run_until_complete(busy())
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        self.assertNotIn(codec.OIP_KEEP_ALIVE, self.oip.received)
+        self.assertEqual(states[0], 'disconnected')
+        self.assertTrue(self.oip.closed)
+
+
+class TestBoschOffline(unittest.TestCase):
+    """Commands sent while the controller is unreachable."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(self.loop.create_server(
+            asyncio.Protocol, '127.0.0.1', 0))
+        port = server.sockets[0].getsockname()[1]
+        server.close()
+        self.loop.run_until_complete(server.wait_closed())
+        self.spk = Speaker_Bosch(self.loop, 'tcp://127.0.0.1:{}'.format(port))
+        self.spk.server.buffer_timeout = 0.05
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.spk.server.conn.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def test_stop_is_not_stuck_behind_buffered_start(self):
+        async def on_off():
+            return await asyncio.gather(
+                self.spk.got_command({'name': 'SPK_1', 'status': 'ON'}),
+                self.spk.got_command({'name': 'SPK_1', 'status': 'OFF'}))
+
+        on, off = self.loop.run_until_complete(
+            asyncio.wait_for(on_off(), 1))
+        self.assertTrue(on['retry'])
+        self.assertEqual(off['ok'], 1)
+        self.assertEqual(self.spk.actions['SPK_1'].status, 'OFF')
+        self.assertEqual(len(self.spk.server.buffer), 0)
+
+
+class TestSpeakerBosch(unittest.TestCase):
+    """Tests for `speaker.speaker_bosch` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.oip = OipServer()
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: OipServerProtocol(self.oip), '127.0.0.1', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.spk = Speaker_Bosch(self.loop, 'tcp://127.0.0.1:{}'.format(port))
+        self.spk.server.conn.backoff = 0.02
+        self.loop.run_until_complete(self.spk.server.conn.wait_connected(1))
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.spk.server.conn.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def test_calls_end_with_the_session(self):
+        command = {'name': 'SPK_1', 'status': 'ON'}
+        self.loop.run_until_complete(self.spk.got_command(command))
+        self.assertIn('SPK_1', self.spk.calls)
+        self.oip.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self.spk.calls, {})
+        self.loop.run_until_complete(self.spk.server.conn.wait_connected(1))
+        del self.oip.received[:]
+        self.loop.run_until_complete(self.spk.got_command(command))
+        self.assertIn(codec.OIP_START_CALL, self.oip.received)
+        self.assertIn('SPK_1', self.spk.calls)
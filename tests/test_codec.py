@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.codec` module."""
+
+
+import struct
+import unittest
+
+from speaker import codec
+from speaker.spon import TerminalSet
+
+
+class TestSponCodec(unittest.TestCase):
+    """Tests for the Spon frame encoders."""
+
+    def test_golden_frames(self):
+        self.assertEqual(codec.spon_encode(codec.SPON_ALARM_TASK, 1, 7, 0),
+                         b'\xff\xff\xca\x01\x07\x00\x00\x00')
+        self.assertEqual(codec.spon_encode(codec.SPON_TERMINAL_CONTROL,
+                                           0, 3, 2),
+                         b'\xff\xff\xc1\x00\x03\x00\x02\x00')
+        terms = TerminalSet([3, 4, 5, 16, 26, 98, 127, 128])
+        self.assertEqual(codec.spon_encode_bitmap(1, 4, terms, 16),
+                         b'\xff\xff\xc3\x01\x04\x00\x00\x00'
+                         b'\x1c\x80\x00\x02' + b'\x00' * 8 +
+                         b'\x02\x00\x00\xc0')
+
+    def test_into_caller_buffer(self):
+        buf = bytearray(32)
+        frame = codec.spon_encode(codec.SPON_ALARM_TASK, 0, 513, 0, buf, 8)
+        self.assertIsInstance(frame, memoryview)
+        self.assertEqual(bytes(buf[8:16]), b'\xff\xff\xca\x00\x01\x02\x00\x00')
+        self.assertEqual(codec.spon_decode(frame), (0xCA, 0, 513, 0))
+        with self.assertRaises(struct.error):
+            codec.spon_encode(codec.SPON_ALARM_TASK, 0, 1, 0, buf, 30)
+        with self.assertRaises(ValueError):
+            codec.spon_decode(b'\xff\xfe\xca\x00\x01\x00\x00\x00')
+
+
+class TestMbapCodec(unittest.TestCase):
+    """Tests for the Modbus TCP frame encoders."""
+
+    def test_golden_frames(self):
+        self.assertEqual(codec.mbap_read_coils(1, 1, 0x10, 8),
+                         b'\x00\x01\x00\x00\x00\x06\x01\x01\x00\x10\x00\x08')
+        self.assertEqual(codec.mbap_write_coil(2, 1, 0x11, 0xFF00),
+                         b'\x00\x02\x00\x00\x00\x06\x01\x05\x00\x11\xff\x00')
+        self.assertEqual(codec.mbap_write_coils(3, 1, 0x10, 10, 0x2A5),
+                         b'\x00\x03\x00\x00\x00\x09\x01\x0f\x00\x10\x00\x0a'
+                         b'\x02\xa5\x02')
+
+    def test_round_trip(self):
+        decoder = codec.MbapDecoder()
+        frame = codec.mbap_write_coils(7, 1, 0x10, 8, 0x81)
+        self.assertEqual(decoder.feed(frame),
+                         [(7, 1, b'\x0f\x00\x10\x00\x08\x01\x81')])
+
+
+class TestOipCodec(unittest.TestCase):
+    """Tests for the OIP encoders writing into caller buffers."""
+
+    def test_into_caller_buffer(self):
+        buf = bytearray(64)
+        frame = codec.oip_stop_call(9, 3, buf, 4)
+        self.assertEqual(len(frame), 20)
+        self.assertEqual(bytes(buf[4:24]),
+                         b'\x04\x70\x44\x00\x14\x00\x00\x00\x00\x00\x00\x00'
+                         b'\x03\x00\x00\x00\x09\x00\x00\x00')
+        with self.assertRaises(ValueError):
+            codec.oip_stop_call(9, 3, buf, 50)
+        self.assertEqual(codec.oip_keep_alive(),
+                         codec.oip_frame(codec.OIP_KEEP_ALIVE))
+        self.assertEqual(codec.oip_login('a', 'b', 1),
+                         codec.oip_frame(codec.OIP_LOGIN,
+                                         codec.oip_string('a') +
+                                         codec.oip_string('b'), 1))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.command` module."""
+
+
+import unittest
+
+from speaker.command import Command, CommandError, parse_name
+
+
+class TestParseName(unittest.TestCase):
+    """Tests for device name parsing."""
+
+    def test_zone_and_task(self):
+        device = parse_name('SPK_12_3')
+        self.assertEqual((device.kind, device.zone, device.task),
+                         ('SPK', 12, 3))
+        device = parse_name('spk_Lobby')
+        self.assertEqual((device.kind, device.zone, device.task),
+                         ('SPK', 'Lobby', None))
+        for name in ('BAD', 'CAM_1', 'SPK_', 'SPK_1_x', 'SPK_1_2_3', 7):
+            with self.assertRaises(CommandError):
+                parse_name(name)
+
+
+class TestCommand(unittest.TestCase):
+    """Tests for decoding and validating action messages."""
+
+    def test_decode(self):
+        command = Command.decode(
+            b'{"name": ["SPK_1", "BAD"], "status": " auto ",'
+            b' "priority": "evacuation"}')
+        self.assertEqual([d.name for d in command.devices], ['SPK_1'])
+        self.assertEqual(command.invalid, ['BAD'])
+        self.assertEqual(command.status, 'AUTO')
+        self.assertEqual(command.priority, 'EVACUATION')
+        self.assertIsNone(Command.decode('{"name": "SPK_1",'
+                                         ' "status": ""}').status)
+
+    def test_malformed_is_rejected(self):
+        for data in (b'{"name": ', b'[1, 2]', b'{"status": "ON"}',
+                     b'{"name": []}', b'{"name": ["BAD"]}',
+                     b'{"name": "SPK_1", "status": 1}'):
+            with self.assertRaises(ValueError):
+                Command.decode(data)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.connection` module."""
+
+
+import asyncio
+import socket
+import unittest
+
+from speaker.connection import CommandBuffer, ConnectionManager
+
+
+class Master(object):
+    def __init__(self):
+        self.events = []
+
+    def connection_made(self, transport):
+        self.events.append('made')
+
+    def data_received(self, data):
+        self.events.append(data)
+
+    def connection_lost(self, exc):
+        self.events.append('lost')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestConnectionManager(unittest.TestCase):
+    """Tests for `speaker.connection.ConnectionManager`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.master = Master()
+        self.port = free_port()
+        self.conn = ConnectionManager(self.loop, '127.0.0.1', self.port,
+                                      self.master, backoff=0.02)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.conn.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def _serve(self):
+        return self.loop.run_until_complete(self.loop.create_server(
+            asyncio.Protocol, '127.0.0.1', self.port))
+
+    def test_first_connect_is_immediate(self):
+        server = self._serve()
+        start = self.loop.time()
+        self.conn.start()
+        ok = self.loop.run_until_complete(self.conn.wait_connected(1))
+        self.assertTrue(ok)
+        self.assertLess(self.loop.time() - start, 0.5)
+        self.assertEqual(self.master.events, ['made'])
+        sock = self.conn.transport.get_extra_info('socket')
+        self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP,
+                                        socket.TCP_NODELAY))
+        self.assertTrue(sock.getsockopt(socket.SOL_SOCKET,
+                                        socket.SO_KEEPALIVE))
+        server.close()
+
+    def test_backoff_until_server_is_up(self):
+        states = []
+        self.conn.add_listener(states.append)
+        self.conn.start()
+        ok = self.loop.run_until_complete(self.conn.wait_connected(0.1))
+        self.assertFalse(ok)
+        self.assertIn('disconnected', states)
+        server = self._serve()
+        ok = self.loop.run_until_complete(self.conn.wait_connected(2))
+        self.assertTrue(ok)
+        self.assertEqual(states[-1], 'connected')
+        server.close()
+
+    def test_reconnect_after_lost(self):
+        server = self._serve()
+        self.conn.start()
+        self.loop.run_until_complete(self.conn.wait_connected(1))
+        self.conn.transport.abort()
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        ok = self.loop.run_until_complete(self.conn.wait_connected(1))
+        self.assertTrue(ok)
+        self.assertEqual(self.master.events, ['made', 'lost', 'made'])
+        server.close()
+
+    def test_backoff_while_sessions_die_at_once(self):
+        class Closer(asyncio.Protocol):
+            def connection_made(self, transport):
+                transport.close()
+
+        server = self.loop.run_until_complete(self.loop.create_server(
+            Closer, '127.0.0.1', self.port))
+        self.conn.max_backoff = 0.08
+        self.conn.start()
+        self.loop.run_until_complete(asyncio.sleep(0.3))
+        made = self.master.events.count('made')
+        # 0.01-0.02, 0.02-0.04, 0.04-0.08 and then at most 0.08 apart
+        self.assertGreaterEqual(made, 3)
+        self.assertLessEqual(made, 10)
+        server.close()
+
+
+class TestCommandBuffer(unittest.TestCase):
+    """Tests for `speaker.connection.CommandBuffer`."""
+
+    def test_collapse_same_key(self):
+        buf = CommandBuffer()
+        self.assertIsNone(buf.put('SPK_1', 'start'))
+        self.assertIsNone(buf.put('SPK_2', 'start'))
+        self.assertEqual(buf.put('SPK_1', 'stop'), 'start')
+        self.assertEqual(buf.drain(), ['start', 'stop'])
+        self.assertEqual(buf.get_info(), {'pending': 0, 'queued': 3,
+                                          'dropped': 0, 'collapsed': 1,
+                                          'flushed': 2})
+
+    def test_bounded_drops_oldest(self):
+        buf = CommandBuffer(maxlen=2)
+        buf.put(None, 'a')
+        buf.put(None, 'b')
+        self.assertEqual(buf.put(None, 'c'), 'a')
+        self.assertEqual(buf.dropped, 1)
+        self.assertEqual(buf.drain(), ['b', 'c'])
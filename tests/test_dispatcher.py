@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.dispatcher` module."""
+
+
+import asyncio
+import unittest
+
+from speaker.dispatcher import CommandScheduler, EMERGENCY
+from speaker.speaker import SpeakerV1
+
+
+class SlowSpeaker(SpeakerV1):
+    async def _do_action(self, device, args, status):
+        if device.name == 'SPK_0':
+            raise ValueError('bad zone')
+        await asyncio.sleep(0.05)
+        return device.name != 'SPK_99'
+
+
+class FlakySpeaker(SpeakerV1):
+    def __init__(self, loop):
+        super().__init__(loop)
+        self.timeout = 20
+        self.sent = []
+
+    async def _do_action(self, device, args, status):
+        self.sent.append(status)
+        self._register(device.name, status,
+                       self.timeout if status == 'AUTO' else 0)
+        # the first command is lost on the way to the device
+        return len(self.sent) > 1
+
+
+class BatchSpeaker(SpeakerV1):
+    supports_batch = True
+
+    def __init__(self, loop):
+        super().__init__(loop)
+        self.applied = []
+
+    async def _do_action(self, device, args, status):
+        await asyncio.sleep(0.01)
+        self.applied.append((device.name, status))
+        return True
+
+    async def _do_batch(self, devices, args, status):
+        await asyncio.sleep(0.01)
+        self.applied.extend((device.name, status) for device in devices)
+        return {device.name: True for device in devices}
+
+
+class TestCommandScheduler(unittest.TestCase):
+    """Tests for `speaker.dispatcher.CommandScheduler`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.log = []
+        self.running = 0
+        self.peak = 0
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.loop.close()
+
+    async def job(self, name, delay=0.01):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        self.log.append(name)
+        await asyncio.sleep(delay)
+        self.running -= 1
+        return name
+
+    def test_per_device_order_and_concurrency(self):
+        scheduler = CommandScheduler(self.loop, concurrency=3)
+        futs = [scheduler.submit('SPK_{}'.format(i % 5), self.job,
+                                 (i % 5, i))
+                for i in range(20)]
+        self.loop.run_until_complete(asyncio.gather(*futs))
+        self.assertEqual(self.peak, 3)
+        for device in range(5):
+            seq = [i for d, i in self.log if d == device]
+            self.assertEqual(seq, sorted(seq))
+        info = scheduler.get_info()
+        self.assertEqual(info['completed'], 20)
+        self.assertEqual(info['pending'], 0)
+        self.assertEqual(info['devices'], 0)
+
+    def test_emergency_lane_goes_first(self):
+        scheduler = CommandScheduler(self.loop, concurrency=1)
+        futs = [scheduler.submit('SPK_1', self.job, 'first')]
+        futs += [scheduler.submit('SPK_{}'.format(i), self.job,
+                                  'routine')
+                 for i in range(2, 5)]
+        futs.append(scheduler.submit('SPK_1', self.job, 'routine'))
+        futs.append(scheduler.submit('SPK_9', self.job, 'evacuate',
+                                     lane=EMERGENCY))
+        futs.append(scheduler.submit('SPK_1', self.job, 'evacuate',
+                                     lane=EMERGENCY))
+        self.assertEqual(scheduler.get_info()['lanes'],
+                         {'emergency': 2, 'routine': 4})
+        self.loop.run_until_complete(asyncio.gather(*futs))
+        self.assertEqual(self.log[:3], ['first', 'evacuate', 'evacuate'])
+
+    def test_failure_is_reported_to_caller(self):
+        scheduler = CommandScheduler(self.loop)
+
+        async def broken():
+            raise ValueError('bad zone')
+
+        fut = scheduler.submit('SPK_1', broken)
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(fut)
+        self.assertEqual(scheduler.get_info()['failed'], 1)
+
+    def test_queue_full(self):
+        scheduler = CommandScheduler(self.loop, concurrency=1, maxsize=2)
+        futs = [scheduler.submit('SPK_1', self.job, i) for i in range(3)]
+        self.assertTrue(scheduler.full())
+        with self.assertRaises(asyncio.QueueFull):
+            scheduler.submit('SPK_1', self.job, 3)
+        self.loop.run_until_complete(asyncio.gather(*futs))
+        self.assertFalse(scheduler.full())
+
+
+class TestGotCommand(unittest.TestCase):
+    """Tests for list commands in `speaker.speaker.SpeakerV1`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.loop.close()
+
+    def test_list_runs_concurrently(self):
+        spk = SlowSpeaker(self.loop, concurrency=16)
+        names = ['SPK_{}'.format(i) for i in range(16)]
+        start = self.loop.time()
+        summary = self.loop.run_until_complete(spk.got_command(
+            {'name': names, 'status': 'ON'}))
+        self.assertLess(self.loop.time() - start, 0.5)
+        self.assertEqual(summary['total'], 16)
+        self.assertEqual(summary['ok'], 15)
+        self.assertEqual(summary['failed'], {'SPK_0': 'bad zone'})
+
+    def test_repeat_skips_device_after_success(self):
+        spk = FlakySpeaker(self.loop)
+        for status in ('AUTO', 'AUTO', 'AUTO', 'OFF', 'AUTO', 'ON', 'ON'):
+            self.loop.run_until_complete(spk.got_command(
+                {'name': 'SPK_1', 'status': status}))
+        self.assertEqual(spk.sent, ['AUTO', 'AUTO', 'OFF', 'AUTO', 'ON'])
+        info = spk.get_info()['dedup']
+        self.assertEqual((info['hits'], info['misses']), (2, 4))
+
+    def test_retry_superseded_by_newer_command(self):
+        spk = FlakySpeaker(self.loop)
+        failed = self.loop.run_until_complete(spk.got_command(
+            {'name': ['SPK_1', 'SPK_2'], 'status': 'AUTO'}))
+        self.assertTrue(failed['retry'])
+        self.assertFalse(spk.superseded(failed))
+        self.loop.run_until_complete(spk.got_command(
+            {'name': 'SPK_2', 'status': 'OFF'}))
+        self.assertTrue(spk.superseded(failed))
+
+    def test_full_queue_takes_no_device(self):
+        spk = SlowSpeaker(self.loop)
+        spk.scheduler.maxsize = 2
+        result = self.loop.run_until_complete(spk.got_command(
+            {'name': ['SPK_1', 'SPK_2', 'SPK_3'], 'status': 'ON'}))
+        self.assertIs(result, False)
+        self.assertEqual(spk.scheduler.get_info()['submitted'], 0)
+
+    def test_timeout_and_bad_name_in_summary(self):
+        spk = SlowSpeaker(self.loop)
+        summary = self.loop.run_until_complete(spk.got_command(
+            {'name': ['SPK_1', 'BAD'], 'status': 'ON'}))
+        self.assertEqual((summary['ok'], list(summary['failed'])),
+                         (1, ['BAD']))
+        self.assertFalse(summary['retry'])
+        summary = self.loop.run_until_complete(spk.got_command(
+            {'name': ['SPK_1', 'SPK_99'], 'status': 'ON'}))
+        self.assertEqual(summary['failed'], {'SPK_99': 'no reply'})
+        self.assertTrue(summary['retry'])
+
+    def test_batch_keeps_device_order(self):
+        spk = BatchSpeaker(self.loop)
+        messages = [{'name': 'SPK_1', 'status': 'ON'},
+                    {'name': 'SPK_1', 'status': 'AUTO'},
+                    {'name': ['SPK_1', 'SPK_2'], 'status': 'OFF'},
+                    {'name': 'SPK_2', 'status': 'ON'},
+                    {'name': 'SPK_1', 'status': 'ON'}]
+        self.loop.run_until_complete(asyncio.gather(
+            *[spk.got_command(mesg) for mesg in messages]))
+        for name, statuses in (('SPK_1', ['ON', 'AUTO', 'OFF', 'ON']),
+                               ('SPK_2', ['OFF', 'ON'])):
+            self.assertEqual([s for n, s in spk.applied if n == name],
+                             statuses)
+        info = spk.scheduler.get_info()
+        self.assertEqual((info['pending'], info['running'],
+                          info['devices']), (0, 0, 0))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.expiry` module."""
+
+
+import asyncio
+import unittest
+
+from speaker.expiry import ExpiryHeap
+from speaker.speaker import SpeakerV1
+
+
+class DummySpeaker(SpeakerV1):
+    def __init__(self, loop):
+        super().__init__(loop)
+        self.released = []
+
+    def _release(self, act, args=None, status='OFF'):
+        self.released.append((act, self.loop.time()))
+
+
+class TestExpiryHeap(unittest.TestCase):
+    """Tests for `speaker.expiry` module."""
+
+    def test_pop_due_in_deadline_order(self):
+        heap = ExpiryHeap()
+        heap.schedule('SPK_3', 30)
+        heap.schedule('SPK_1', 10)
+        heap.schedule('SPK_2', 20)
+        self.assertEqual(heap.next_deadline(), 10)
+        self.assertEqual(heap.pop_due(25), ['SPK_1', 'SPK_2'])
+        self.assertEqual(heap.next_deadline(), 30)
+        self.assertEqual(len(heap), 1)
+
+    def test_reschedule_and_cancel(self):
+        heap = ExpiryHeap()
+        heap.schedule('SPK_1', 10)
+        heap.schedule('SPK_1', 40)
+        heap.schedule('SPK_2', 20)
+        heap.cancel('SPK_2')
+        self.assertEqual(heap.next_deadline(), 40)
+        self.assertEqual(heap.pop_due(30), [])
+        self.assertEqual(heap.pop_due(40), ['SPK_1'])
+        self.assertIsNone(heap.next_deadline())
+
+    def test_compaction_bounds_heap(self):
+        heap = ExpiryHeap()
+        for i in range(10000):
+            heap.schedule('SPK_1', i)
+        self.assertEqual(len(heap), 1)
+        self.assertLess(len(heap.heap), 100)
+
+
+class TestRelease(unittest.TestCase):
+    """Tests for the release timer of `speaker.speaker.SpeakerV1`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        self.site = DummySpeaker(self.loop)
+        self.site.start()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.loop.close()
+
+    def test_release_at_deadline(self):
+        start = self.loop.time()
+        self.site._register('SPK_1', 'AUTO', 0.05)
+        self.site._register('SPK_2', 'ON', 0)
+        self.assertAlmostEqual(self.site.next_deadline() - start, 0.05,
+                               places=2)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual([a for a, _ in self.site.released], ['SPK_1'])
+        self.assertGreaterEqual(self.site.released[0][1] - start, 0.05)
+        self.assertEqual(self.site.actions['SPK_1'].status, 'Off/Stop')
+        self.assertEqual(self.site.actions['SPK_2'].status, 'ON')
+        self.assertIsNone(self.site.next_deadline())
+
+    def test_register_without_timeout_cancels_release(self):
+        self.site._register('SPK_1', 'AUTO', 0.05)
+        self.site._register('SPK_1', 'OFF', 0)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(self.site.released, [])
+        self.assertIsNone(self.site.release_timer)
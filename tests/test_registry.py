@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.registry` module."""
+
+
+import json
+import os
+import tempfile
+import unittest
+
+from speaker.command import Command, CommandError
+from speaker.registry import DeviceRegistry
+
+CONFIG = {
+    'devices': {
+        'SPK_101': {'driver': 'spon', 'terminal': 101,
+                    'server': 'udp://10.0.0.2:2048', 'groups': ['FLOOR_3']},
+        'LOBBY': {'driver': 'bosch', 'zone': 'Lobby'},
+        'SIREN': {'driver': 'spon', 'terminal': '7', 'task': 2},
+    },
+    'groups': {
+        'FLOOR_3': ['SPK_102', 'SPK_110-115', 'SPK_101'],
+    }
+}
+
+
+class TestDeviceRegistry(unittest.TestCase):
+    """Tests for `speaker.registry.DeviceRegistry`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(CONFIG, f)
+        self.registry = DeviceRegistry.load(self.path, driver='spon',
+                                            cache_size=2)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        os.remove(self.path)
+
+    def test_load(self):
+        siren = self.registry.lookup('SIREN')
+        self.assertEqual((siren.zone, siren.task), (7, 2))
+        self.assertEqual(self.registry.lookup('SPK_101').server,
+                         'udp://10.0.0.2:2048')
+        floor = self.registry.expand('FLOOR_3')
+        self.assertEqual([d.zone for d in floor],
+                         [101, 102, 110, 111, 112, 113, 114, 115])
+        self.assertIs(self.registry.lookup('SPK_112'), floor[4])
+        with self.assertRaises(CommandError):
+            self.registry.lookup('LOBBY')
+
+    def test_parse_cache(self):
+        for name in ('SPK_1', 'SPK_2', 'SPK_1', 'SPK_3', 'SPK_2'):
+            self.registry.lookup(name)
+        cache = self.registry.get_info()['cache']
+        self.assertEqual((cache['hits'], cache['misses']), (1, 4))
+        self.assertEqual(list(self.registry.cache), ['SPK_3', 'SPK_2'])
+        self.assertEqual(self.registry.lookup('SPK_3_4').task, 4)
+
+    def test_command_expands_groups(self):
+        command = Command.decode(
+            b'{"name": ["SPK_101", "FLOOR_3", "SPK_1", "LOBBY"],'
+            b' "status": "ON"}', self.registry)
+        self.assertEqual([d.zone for d in command.devices],
+                         [101, 102, 110, 111, 112, 113, 114, 115, 1])
+        self.assertEqual(command.invalid, ['LOBBY'])
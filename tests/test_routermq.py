@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.routermq` module."""
+
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from speaker.command import Command
+from speaker.routermq import RouterMQ
+
+
+class Exchange(object):
+    def __init__(self):
+        self.sent = []
+        self.broken = False
+
+    def publish(self, message, routing_key, *, mandatory=True):
+        if self.broken:
+            raise ConnectionError('channel closed')
+        self.sent.append((routing_key, message.json()))
+
+
+class Message(object):
+    routing_key = 'Actions.speaker'
+
+    def __init__(self, body, redelivered=False):
+        self.data = body
+        self.body = body if isinstance(body, bytes) else repr(body).encode()
+        self.redelivered = redelivered
+        self.settled = None
+
+    def json(self):
+        if self.data is None:
+            raise ValueError('no json')
+        return self.data
+
+    def ack(self):
+        self.settled = 'ack'
+
+    def reject(self, *, requeue=True):
+        self.settled = 'requeue' if requeue else 'reject'
+
+
+class Flow(object):
+    def __init__(self):
+        self.ready = asyncio.Event()
+
+    def full(self):
+        return not self.ready.is_set()
+
+    async def wait_not_full(self):
+        await self.ready.wait()
+
+
+class TestPublish(unittest.TestCase):
+    """Tests for the buffered publish pipeline."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        fd, self.spill = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.spill)
+        self.router = RouterMQ(loop=self.loop, buffer_size=3)
+        self.exchange = Exchange()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        if os.path.exists(self.spill):
+            os.remove(self.spill)
+        self.loop.close()
+
+    def tick(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_buffered_until_connected(self):
+        for i in range(5):
+            self.router.publish({'n': i})
+        info = self.router.get_info()['publish']
+        self.assertEqual(info['pending'], 3)
+        self.assertEqual(info['dropped'], 2)
+        self.router.exchange = self.exchange
+        self.router._schedule_flush()
+        self.tick()
+        self.assertEqual([m['n'] for _, m in self.exchange.sent], [2, 3, 4])
+        self.assertEqual(self.router.get_info()['publish']['published'], 3)
+
+    def test_spill_keeps_order(self):
+        self.router.spill_path = self.spill
+        for i in range(5):
+            self.router.publish({'n': i})
+        self.assertEqual(self.router.get_info()['publish']['spilled'], 2)
+        self.router.exchange = self.exchange
+        self.router._schedule_flush()
+        self.tick()
+        self.assertEqual([m['n'] for _, m in self.exchange.sent],
+                         [0, 1, 2, 3, 4])
+        self.assertFalse(os.path.exists(self.spill))
+
+    def test_batched_per_tick_and_kept_on_error(self):
+        self.router.exchange = self.exchange
+        self.router.publish({'n': 1})
+        self.router.publish({'n': 2}, 'Alarms.other')
+        self.assertEqual(self.exchange.sent, [])
+        self.tick()
+        self.assertEqual(self.exchange.sent,
+                         [('Alarms.keeper', {'n': 1}),
+                          ('Alarms.other', {'n': 2})])
+        self.exchange.broken = True
+        self.router.publish({'n': 3})
+        self.tick()
+        self.assertEqual(len(self.router.outbox), 1)
+
+
+class TestConsume(unittest.TestCase):
+    """Tests for acking and flow control of consumed messages."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.router = RouterMQ(loop=self.loop, max_in_flight=2,
+                               requeue_delay=0)
+        self.running = 0
+        self.peak = 0
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.loop.close()
+
+    async def handler(self, mesg):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if mesg.get('fail'):
+            raise RuntimeError('device down')
+        return {'retry': mesg.get('retry', False)}
+
+    def settle(self, messages):
+        for message in messages:
+            self.router.handle_message(message)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        return [message.settled for message in messages]
+
+    def test_ack_after_dispatch(self):
+        self.router.set_callback(self.handler)
+        messages = [Message({'n': 1}), Message({'fail': True}),
+                    Message({'retry': True}), Message(None)]
+        self.assertEqual(self.settle(messages),
+                         ['ack', 'requeue', 'requeue', 'reject'])
+        self.assertEqual(self.peak, 2)
+        info = self.router.get_info()['consume']
+        self.assertEqual((info['acked'], info['requeued'], info['rejected'],
+                          info['in_flight']), (1, 2, 1, 0))
+
+    def test_retries_are_capped(self):
+        self.router.set_callback(self.handler)
+        self.router.max_retries = 2
+        settled = []
+        for redelivered in (False, True, True, True):
+            settled += self.settle([Message({'retry': True}, redelivered)])
+        self.assertEqual(settled, ['requeue', 'requeue', 'reject',
+                                   'requeue'])
+        self.assertEqual(self.router.get_info()['consume']['exhausted'], 1)
+
+    def test_superseded_retry_is_dropped(self):
+        self.router.set_callback(self.handler)
+        self.router.set_superseded(lambda result: result['retry'] == 'old')
+        messages = [Message({'retry': 'old'}), Message({'retry': 'new'})]
+        self.assertEqual(self.settle(messages), ['ack', 'requeue'])
+        self.assertEqual(
+            self.router.get_info()['consume']['dropped_stale'], 1)
+
+    def test_held_while_flow_full(self):
+        flow = Flow()
+        self.router.set_callback(self.handler)
+        self.router.set_flow(flow)
+        messages = [Message({'n': 1})]
+        self.assertEqual(self.settle(messages), [None])
+        self.assertEqual(self.router.get_info()['consume']['throttled'], 1)
+        flow.ready.set()
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(messages[0].settled, 'ack')
+
+    def test_decoded_before_dispatch(self):
+        received = []
+
+        async def handler(command):
+            received.append(command)
+
+        self.router.decode = Command.decode
+        self.router.set_callback(handler)
+        messages = [Message(b'{"name": "SPK_1", "status": "on"}'),
+                    Message(b'{"name": "CAM_1"}'), Message(b'{')]
+        self.assertEqual(self.settle(messages), ['ack', 'reject', 'reject'])
+        self.assertEqual([d.zone for d in received[0].devices], [1])
+        self.assertEqual(received[0].status, 'ON')
+
+
+class FlakyRouter(RouterMQ):
+    def __init__(self, failures, die=False, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.die = die
+        self.attempts = []
+
+    async def _connect(self):
+        self.attempts.append(self.loop.time())
+        if len(self.attempts) <= self.failures:
+            return False
+        self.exchange = Exchange()
+        self.lost.clear()
+        self.ready.set()
+        if self.die:
+            # the broker drops the session right after consume
+            self.loop.call_soon(self._connection_lost, None)
+        return True
+
+
+class TestReconnect(unittest.TestCase):
+    """Tests for the event driven reconnector."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.loop.close()
+
+    def test_backoff_then_ready(self):
+        router = FlakyRouter(3, loop=self.loop, backoff=0.02,
+                             max_backoff=0.04)
+        task = self.loop.create_task(router.reconnector())
+        ok = self.loop.run_until_complete(router.wait_ready(1))
+        self.assertTrue(ok)
+        gaps = [b - a for a, b in zip(router.attempts, router.attempts[1:])]
+        self.assertEqual(len(gaps), 3)
+        self.assertTrue(all(0.01 <= gap <= 0.06 for gap in gaps))
+        self.assertTrue(router.get_info()['connected'])
+
+        router._connection_lost(None)
+        self.assertFalse(router.get_info()['connected'])
+        self.assertIsNone(router.exchange)
+        ok = self.loop.run_until_complete(router.wait_ready(1))
+        self.assertTrue(ok)
+        self.assertEqual(len(router.attempts), 5)
+        self.assertEqual(router.reconnects, 1)
+        task.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_backoff_while_sessions_die(self):
+        router = FlakyRouter(0, die=True, loop=self.loop, backoff=0.02,
+                             max_backoff=0.08)
+        task = self.loop.create_task(router.reconnector())
+        self.loop.run_until_complete(asyncio.sleep(0.3))
+        gaps = [b - a for a, b in zip(router.attempts, router.attempts[1:])]
+        self.assertTrue(3 <= len(router.attempts) <= 10)
+        self.assertTrue(all(gap >= 0.01 for gap in gaps))
+        task.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0))
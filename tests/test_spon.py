@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `speaker.spon` module."""
+
+
+import asyncio
+import unittest
+
+from speaker import codec
+from speaker.registry import DeviceRegistry
+from speaker.spon import Spon, SponCluster, TerminalSet
+from speaker.speaker_spon import Speaker_Spon, parse_terminals
+
+
+def extend_frame(act, terminals):
+    return bytes(codec.spon_encode_bitmap(act, 1, TerminalSet(terminals),
+                                          codec.SPON_EXTEND_BYTES))
+
+
+class EchoServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.drop = 0
+        self.received = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received.append(data)
+        if self.delay is None:
+            return
+        if self.drop:
+            self.drop -= 1
+            return
+        asyncio.get_event_loop().call_later(self.delay,
+                                            self.transport.sendto,
+                                            data, addr)
+
+
+class TestTerminalSet(unittest.TestCase):
+    """Tests for `speaker.spon.TerminalSet`."""
+
+    def test_bitmap_layout(self):
+        terms = TerminalSet([3, 4, 5, 16, 26, 98, 127, 128], 128)
+        self.assertEqual(bytes(terms.bits),
+                         b'\x1c\x80\x00\x02' + b'\x00' * 8 +
+                         b'\x02\x00\x00\xc0')
+        self.assertEqual(list(terms), [3, 4, 5, 16, 26, 98, 127, 128])
+        self.assertEqual(len(terms), 8)
+        self.assertEqual(terms.max(), 128)
+        terms.discard(128)
+        self.assertNotIn(128, terms)
+        self.assertEqual(terms.max(), 127)
+
+    def test_out_of_range(self):
+        terms = TerminalSet()
+        with self.assertRaises(ValueError):
+            terms.add(0)
+        with self.assertRaises(ValueError):
+            terms.add(1001)
+        self.assertNotIn(1001, terms)
+        terms.add(200)
+        with self.assertRaises(ValueError):
+            terms.pack_into(bytearray(16), 0, 16)
+        for ids in ([0], [5, 1001], [-1], iter([3, -300])):
+            with self.assertRaises(ValueError):
+                TerminalSet(ids)
+        self.assertEqual(list(TerminalSet(iter([9, 1, 9]), 16)), [1, 9])
+
+    def test_algebra_and_delta(self):
+        active = TerminalSet([1, 2, 3])
+        desired = TerminalSet([3, 4, 500])
+        self.assertEqual(list(active | desired), [1, 2, 3, 4, 500])
+        self.assertEqual(list(active & desired), [3])
+        start, stop = active.delta(desired)
+        self.assertEqual(list(start), [4, 500])
+        self.assertEqual(list(stop), [1, 2])
+        self.assertEqual((active - stop) | start, desired)
+
+
+class TestSpon(unittest.TestCase):
+    """Tests for `speaker.spon` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.echo = EchoServerProtocol()
+        self.server, _ = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(
+                lambda: self.echo, local_addr=('127.0.0.1', 0)))
+        host, port = self.server.get_extra_info('sockname')
+        self.spon = Spon(self.loop, host, port, timeout=0.5)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.spon.close()
+        self.server.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def test_alarm_task_reply(self):
+        reps = self.loop.run_until_complete(self.spon.alarm_task('start', 7))
+        self.assertEqual(reps, b'\xff\xff\xca\x01\x07\x00\x00\x00')
+
+    def test_broadcast_control_frame(self):
+        reps = self.loop.run_until_complete(self.spon.broadcast_control(
+            'start', [3, 4, 5, 16, 98, 128, 127, 26], 4))
+        self.assertEqual(reps, b'\xff\xff\xc3\x01\x04\x00\x00\x00'
+                               b'\x1c\x80\x00\x02' + b'\x00' * 8 +
+                               b'\x02\x00\x00\xc0')
+        reps = self.loop.run_until_complete(self.spon.broadcast_extend(
+            'stop', [1000], 3))
+        self.assertEqual(len(reps), 8 + 125)
+        self.assertEqual(reps[3], 0x02)
+        self.assertEqual(reps[-1], 0x80)
+
+    def test_concurrent_requests(self):
+        self.echo.delay = 0.05
+
+        async def fan_out():
+            return await asyncio.gather(
+                *[self.spon.alarm_task('start', i) for i in range(1, 101)])
+
+        reps = self.loop.run_until_complete(
+            asyncio.wait_for(fan_out(), 1.0))
+        self.assertEqual(len(reps), 100)
+        self.assertTrue(all(r is not None for r in reps))
+        self.assertEqual(len(self.echo.received), 100)
+
+    def test_timeout_returns_none(self):
+        self.echo.delay = None
+        self.spon.rto = self.spon.max_rto = 0.02
+        reps = self.loop.run_until_complete(self.spon.alarm_task('stop', 3))
+        self.assertIsNone(reps)
+        self.assertFalse(any(self.spon.pending.values()))
+        self.assertEqual(len(self.echo.received), 4)
+        info = self.spon.get_info()
+        self.assertEqual(info['retransmits'], 3)
+        self.assertEqual(info['timeouts'], 1)
+
+    def test_retransmit_after_loss(self):
+        self.loop.run_until_complete(self.spon.alarm_task('start', 1))
+        self.assertIsNotNone(self.spon.srtt)
+        self.assertEqual(self.spon.rto, self.spon.min_rto)
+        self.echo.drop = 1
+        reps = self.loop.run_until_complete(self.spon.alarm_task('start', 2))
+        self.assertEqual(reps, b'\xff\xff\xca\x01\x02\x00\x00\x00')
+        info = self.spon.get_info()
+        self.assertEqual(info['retransmits'], 1)
+        self.assertEqual(info['replies'], 2)
+
+    def test_reply_matched_on_terminal(self):
+        self.echo.delay = None
+
+        async def crossed():
+            first = self.loop.create_task(self.spon.alarm_task('start', 1))
+            second = self.loop.create_task(self.spon.alarm_task('start', 2))
+            await asyncio.sleep(0.01)
+            self.spon.datagram_received(
+                b'\xff\xff\xca\x01\x02\x00\x00\x00', None)
+            self.spon.datagram_received(
+                b'\xff\xff\xca\x01\x01\x00\x00\x00', None)
+            return await first, await second
+
+        first, second = self.loop.run_until_complete(crossed())
+        self.assertEqual(first[4], 1)
+        self.assertEqual(second[4], 2)
+
+    def test_reply_matched_on_action(self):
+        self.echo.delay = None
+
+        async def crossed():
+            start = self.loop.create_task(
+                self.spon.broadcast_extend('start', [1]))
+            stop = self.loop.create_task(
+                self.spon.broadcast_extend('stop', [2]))
+            await asyncio.sleep(0.01)
+            self.spon.datagram_received(extend_frame(0x02, [2]), None)
+            self.spon.datagram_received(extend_frame(0x03, [1]), None)
+            return await start, await stop
+
+        start, stop = self.loop.run_until_complete(crossed())
+        self.assertEqual(start[3], 0x03)
+        self.assertEqual(stop[3], 0x02)
+
+    def test_retry_budget(self):
+        self.echo.delay = None
+        self.spon.rto = self.spon.max_rto = 0.01
+        self.spon.retry_tokens = 1.0
+        self.loop.run_until_complete(self.spon.alarm_task('stop', 3))
+        info = self.spon.get_info()
+        self.assertEqual(info['retransmits'], 1)
+        self.assertEqual(info['budget_exhausted'], 1)
+
+
+class TestSpeakerSpon(unittest.TestCase):
+    """Tests for `speaker.speaker_spon` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.echo = EchoServerProtocol()
+        self.server, _ = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(
+                lambda: self.echo, local_addr=('127.0.0.1', 0)))
+        host, port = self.server.get_extra_info('sockname')
+        self.spk = Speaker_Spon(self.loop, 'udp://{}:{}'.format(host, port))
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.spk.server.close()
+        self.server.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def test_list_command_is_one_frame(self):
+        names = ['SPK_{}'.format(i) for i in range(1, 201)] + ['BAD']
+        summary = self.loop.run_until_complete(self.spk.got_command(
+            {'name': names, 'status': 'ON'}))
+        self.assertEqual(summary['total'], 201)
+        self.assertEqual(summary['ok'], 200)
+        self.assertEqual(list(summary['failed']), ['BAD'])
+        self.assertEqual(len(self.echo.received), 1)
+        self.assertEqual(self.echo.received[0][2:4], b'\xc3\x03')
+
+    def test_window_coalesces_single_commands(self):
+        async def alarm():
+            return await asyncio.gather(
+                *[self.spk.got_command({'name': 'SPK_{}'.format(i),
+                                        'status': 'ON' if i % 2 else 'OFF'})
+                  for i in range(1, 101)])
+
+        self.loop.run_until_complete(alarm())
+        self.assertEqual(len(self.echo.received), 2)
+        self.assertEqual(sorted(d[3] for d in self.echo.received), [2, 3])
+        info = self.spk.get_info()['batch']
+        self.assertEqual(info['commands'], 100)
+        self.assertEqual(info['frames'], 2)
+
+    def test_later_command_wins_in_window(self):
+        async def flip():
+            command = self.spk.got_command({'name': 'SPK_3', 'status': 'ON'})
+            task = self.loop.create_task(command)
+            await asyncio.sleep(0.005)
+            self.spk._release('SPK_3')
+            await task
+
+        self.loop.run_until_complete(flip())
+        self.assertEqual(self.echo.received, [extend_frame(0x02, [3])])
+
+    def test_stop_alone_undoes_group_start(self):
+        self.loop.run_until_complete(self.spk.got_command(
+            {'name': ['SPK_5', 'SPK_6'], 'status': 'ON'}))
+        self.loop.run_until_complete(self.spk.got_command(
+            {'name': 'SPK_5', 'status': 'OFF'}))
+        self.assertEqual(self.echo.received, [extend_frame(0x03, [5, 6]),
+                                              extend_frame(0x02, [5])])
+
+    def test_one_broadcast_per_action_in_flight(self):
+        async def overlap():
+            batches = [self.loop.create_task(self.spk._send_batch(
+                self.spk.server, 'start', {d: []})) for d in (1, 2)]
+            await asyncio.sleep(0.02)
+            sent = len(self.echo.received)
+            await asyncio.gather(*batches)
+            return sent
+
+        self.echo.delay = 0.05
+        self.assertEqual(self.loop.run_until_complete(overlap()), 1)
+        self.assertEqual(self.echo.received, [extend_frame(0x03, [1]),
+                                              extend_frame(0x03, [2])])
+
+    def test_only_delta_is_started(self):
+        names = ['SPK_{}'.format(i) for i in range(1, 11)]
+        self.loop.run_until_complete(self.spk.got_command(
+            {'name': names, 'status': 'AUTO'}))
+        # ON is no repeat of AUTO, so the speaker drops the playing ones
+        self.loop.run_until_complete(self.spk.got_command(
+            {'name': names + ['SPK_11'], 'status': 'ON'}))
+        self.assertEqual(len(self.echo.received), 2)
+        self.assertEqual(self.echo.received[1], extend_frame(0x03, [11]))
+        self.assertEqual(self.spk.get_info()['batch']['skipped'], 10)
+        self.loop.run_until_complete(self.spk.got_command(
+            {'name': names, 'status': 'OFF'}))
+        self.assertEqual(list(self.spk.active), [11])
+
+    def test_playing_terminals_age_out(self):
+        self.spk.active_ttl = 0.1
+        for status in ('AUTO', 'ON'):
+            self.loop.run_until_complete(self.spk.got_command(
+                {'name': 'SPK_3', 'status': status}))
+        self.assertEqual(len(self.echo.received), 1)
+        self.assertEqual(self.spk.skipped, 1)
+        # stopped at the console, so the next start has to be sent
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.loop.run_until_complete(self.spk.got_command(
+            {'name': 'SPK_3', 'status': 'AUTO'}))
+        self.assertEqual(len(self.echo.received), 2)
+
+    def test_repeated_auto_extends_deadline(self):
+        command = {'name': ['SPK_1', 'SPK_2'], 'status': 'AUTO'}
+        self.loop.run_until_complete(self.spk.got_command(command))
+        deadline = self.spk.next_deadline()
+        summary = self.loop.run_until_complete(self.spk.got_command(command))
+        self.assertEqual(summary['ok'], 2)
+        self.assertEqual(len(self.echo.received), 1)
+        self.assertGreater(self.spk.next_deadline(), deadline)
+        self.assertEqual(self.spk.get_info()['dedup'],
+                         {'hits': 2, 'misses': 2, 'settled': 2})
+
+    def test_repeat_after_failure_is_sent(self):
+        self.echo.delay = None
+        self.spk.server.rto = self.spk.server.max_rto = 0.01
+        command = {'name': 'SPK_12', 'status': 'AUTO'}
+        self.loop.run_until_complete(self.spk.got_command(command))
+        self.assertEqual(self.spk.settled, {})
+        sent = len(self.echo.received)
+        self.echo.delay = 0
+        self.loop.run_until_complete(self.spk.got_command(command))
+        self.assertGreater(len(self.echo.received), sent)
+        self.assertEqual(self.spk.settled, {'SPK_12': 'AUTO'})
+        self.assertEqual(self.spk.get_info()['dedup']['hits'], 0)
+
+
+class TestSponCluster(unittest.TestCase):
+    """Tests for `speaker.spon.SponCluster` and cluster mode."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.echos = []
+        self.servers = []
+        urls = []
+        for terminals in ('1-100', '101-200,999', ''):
+            echo = EchoServerProtocol()
+            server, _ = self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(
+                    lambda: echo, local_addr=('127.0.0.1', 0)))
+            host, port = server.get_extra_info('sockname')
+            url = 'udp://{}:{}'.format(host, port)
+            if terminals:
+                url += '?terminals=' + terminals
+            urls.append(url)
+            self.echos.append(echo)
+            self.servers.append(server)
+        self.urls = urls
+        self.spk = Speaker_Spon(self.loop, ';'.join(urls))
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.spk.cluster.close()
+        for server in self.servers:
+            server.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def test_routing_table(self):
+        self.assertEqual(parse_terminals('1-100, 305,'), ([(1, 100)], [305]))
+        a, b, c = Spon(None, 'a', 1), Spon(None, 'b', 1), Spon(None, 'c', 1)
+        cluster = SponCluster(default=c)
+        cluster.add(a, [(1, 100)])
+        cluster.add(b, [(101, 200)], [50])
+        self.assertIs(cluster.route(1), a)
+        self.assertIs(cluster.route(50), b)
+        self.assertIs(cluster.route(150), b)
+        self.assertIs(cluster.route(201), c)
+        with self.assertRaises(ValueError):
+            cluster.add(c, [(90, 110)])
+
+    def test_commands_split_by_server(self):
+        names = ['SPK_{}'.format(i) for i in (1, 2, 150, 999, 500)]
+        summary = self.loop.run_until_complete(self.spk.got_command(
+            {'name': names, 'status': 'ON'}))
+        self.assertEqual(summary['ok'], 5)
+        first, second, default = [e.received for e in self.echos]
+        self.assertEqual(len(first), 1)
+        self.assertEqual(first[0][3], 0x03)
+        self.assertEqual(len(second), 1)
+        self.assertEqual(second[0][3], 0x03)
+        self.assertEqual(default, [extend_frame(0x03, [500])])
+        self.assertEqual(len(self.spk.get_info()['servers']), 3)
+
+    def test_registry_pins_devices(self):
+        registry = DeviceRegistry()
+        registry.configure({
+            'devices': {'SPK_500': {'server': self.urls[0].split('?')[0]}},
+            'groups': {'WING': ['SPK_499-500']}})
+        spk = Speaker_Spon(self.loop, self.urls[2], registry=registry)
+        summary = self.loop.run_until_complete(spk.got_command(
+            {'name': 'WING', 'status': 'ON'}))
+        spk.cluster.close()
+        self.assertEqual(summary['ok'], 2)
+        first, _, default = [e.received for e in self.echos]
+        self.assertEqual(first, [extend_frame(0x03, [500])])
+        self.assertEqual(default, [extend_frame(0x03, [499])])